@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""
+caches.py -- Udacity conference server-side Python App Engine
+    per-instance caches that sit in front of memcache and datastore, and
+    hot-key protection for memcache entries every page reads
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import collections
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from settings import HOT_KEY_REPLICAS
+from settings import PROFILE_CACHE_SECONDS
+
+# how long a thread waits for another thread's memcache read of the same key
+COALESCE_TIMEOUT = 1.0
+# per-instance counters are added to the shared memcache counters this often
+STATS_FLUSH_SECONDS = 10
+MEMCACHE_STATS_PREFIX = "CACHESTATS:"
+MEMCACHE_STATS_SINCE_KEY = "CACHESTATS:since"
+STATS = ('hits', 'misses', 'coalesced', 'memcacheGets', 'memcacheSets')
+# marks a key the local cache has no entry for (None is a cached miss)
+_MISSING = object()
+
+
+class LocalCache(object):
+    """LocalCache -- small thread-safe dict with a per-entry time to live.
+
+    Lives for the lifetime of the instance, so entries are only as fresh
+    as the TTL allows; keep TTLs short for anything users can change.
+    """
+
+    def __init__(self, ttl, maxSize=1000):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[1] < time.time():
+            return default
+        return entry[0]
+
+    def get_multi(self, keys):
+        """Return a dict of the keys found in the cache."""
+        now = time.time()
+        found = {}
+        for key in keys:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] >= now:
+                found[key] = entry[0]
+        return found
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if len(self._data) >= self.maxSize and key not in self._data:
+                self._evictExpired()
+            if len(self._data) >= self.maxSize:
+                # still full of live entries; start over rather than grow
+                self._data.clear()
+            self._data[key] = (value, expires)
+
+    def set_multi(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evictExpired(self):
+        now = time.time()
+        for key in [k for k, v in self._data.items() if v[1] < now]:
+            del self._data[key]
+
+
+class HotKeyCache(object):
+    """HotKeyCache -- LocalCache in front of memcache keys every page reads.
+
+    Concurrent misses for a key are coalesced: one thread reads memcache
+    and the others wait for its result. With replicas > 1, values are
+    written under that many memcache keys and each read picks one at
+    random, so a single hot key is spread over several memcache servers.
+    Writers must go through set/delete so every replica changes.
+    """
+
+    def __init__(self, name, ttl, replicas=1, maxSize=1000):
+        self.name = name
+        self.replicas = max(1, replicas)
+        self._local = LocalCache(ttl, maxSize)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._pending = collections.Counter()
+        self._flushed = time.time()
+        # totals for this instance since it started
+        self.totals = collections.Counter()
+
+    def _replicaKeys(self, key):
+        # the first replica is the plain key, so readers of older
+        # versions still find the value
+        return [key] + ['%s#%d' % (key, i) for i in range(1, self.replicas)]
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._pending[stat] += n
+            due = time.time() - self._flushed >= STATS_FLUSH_SECONDS
+        if due:
+            self.flushStats()
+
+    def _readMemcache(self, key):
+        replica = random.choice(self._replicaKeys(key))
+        self._count('memcacheGets')
+        value = memcache.get(replica)
+        if value is None and replica != key:
+            # an evicted replica; the plain key may still be there
+            self._count('memcacheGets')
+            value = memcache.get(key)
+        return value
+
+    def get(self, key, default=None):
+        """Return the value of key, reading memcache at most once per TTL."""
+        value = self._local.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('hits')
+            return default if value is None else value
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+        if not leader:
+            event.wait(COALESCE_TIMEOUT)
+            value = self._local.get(key, _MISSING)
+            if value is not _MISSING:
+                self._count('coalesced')
+                return default if value is None else value
+        self._count('misses')
+        try:
+            value = self._readMemcache(key)
+            # misses are cached too, so absent keys don't reach memcache
+            self._local.set(key, value)
+        finally:
+            if leader:
+                with self._lock:
+                    del self._inflight[key]
+                event.set()
+        return default if value is None else value
+
+    def get_multi(self, keys):
+        """Return a dict of the keys found, reading misses in one batch."""
+        found = self._local.get_multi(keys)
+        self._count('hits', len(found))
+        missing = [key for key in keys if key not in found]
+        if missing:
+            self._count('misses', len(missing))
+            self._count('memcacheGets')
+            fetched = memcache.get_multi(missing)
+            for key in missing:
+                self._local.set(key, fetched.get(key))
+            found.update(fetched)
+        return dict((key, value) for key, value in found.items()
+                    if value is not None)
+
+    def set(self, key, value):
+        """Write value to every replica and to this instance."""
+        self._count('memcacheSets')
+        memcache.set_multi(dict((replica, value) for replica in
+                                self._replicaKeys(key)))
+        self._local.set(key, value)
+
+    def delete(self, key):
+        """Delete every replica and this instance's copy."""
+        self._count('memcacheSets')
+        memcache.delete_multi(self._replicaKeys(key))
+        self._local.delete(key)
+
+    def clear(self):
+        """Forget this instance's copies; memcache is left alone."""
+        self._local.clear()
+
+    def flushStats(self):
+        """Add this instance's pending counters to the memcache totals."""
+        with self._lock:
+            pending, self._pending = self._pending, collections.Counter()
+            self._flushed = time.time()
+        self.totals.update(pending)
+        if pending:
+            memcache.add(MEMCACHE_STATS_SINCE_KEY, self._flushed)
+            memcache.offset_multi(
+                dict(('%s:%s' % (self.name, stat), n) for stat, n in
+                     pending.items()),
+                key_prefix=MEMCACHE_STATS_PREFIX, initial_value=0)
+
+
+def cacheStats(reset=False):
+    """Return hit rate and memcache QPS of every hot-key cache.
+
+    The counters are shared by all instances through memcache; each
+    instance adds its own every STATS_FLUSH_SECONDS.
+    """
+    caches = (ANNOUNCEMENT_CACHE, FEATURED_CACHE)
+    keys = ['%s:%s' % (cache.name, stat) for cache in caches
+            for stat in STATS]
+    counters = memcache.get_multi(keys, key_prefix=MEMCACHE_STATS_PREFIX)
+    since = memcache.get(MEMCACHE_STATS_SINCE_KEY)
+    elapsed = max(time.time() - since, 1.0) if since else None
+    report = {'seconds': elapsed, 'caches': {}}
+    for cache in caches:
+        stats = dict((stat, int(counters.get('%s:%s' % (cache.name, stat),
+                                             0))) for stat in STATS)
+        lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['hitRate'] = (float(lookups - stats['misses']) / lookups
+                            if lookups else None)
+        stats['memcacheQps'] = ((stats['memcacheGets'] +
+                                 stats['memcacheSets']) / elapsed
+                                if elapsed else None)
+        stats['replicas'] = cache.replicas
+        stats['instance'] = dict(cache.totals)
+        report['caches'][cache.name] = stats
+    if reset:
+        memcache.delete_multi(keys, key_prefix=MEMCACHE_STATS_PREFIX)
+        memcache.delete(MEMCACHE_STATS_SINCE_KEY)
+    return report
+
+
+# announcement text and featured speakers, keyed like their memcache keys
+ANNOUNCEMENT_CACHE = HotKeyCache('announcement', ttl=30,
+                                 replicas=HOT_KEY_REPLICAS)
+FEATURED_CACHE = HotKeyCache('featured', ttl=30, replicas=HOT_KEY_REPLICAS)
+# organizer displayName by user ID
+ORGANIZER_NAMES = LocalCache(ttl=60, maxSize=5000)
+# Profile properties by user ID, None for users without a stored Profile
+PROFILES = LocalCache(ttl=PROFILE_CACHE_SECONDS, maxSize=5000)
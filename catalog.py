@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+catalog.py -- Udacity conference server-side Python App Engine
+    public conference catalog materialized into versioned, gzipped pages
+    that the default conference listing reads instead of queryConferences
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import gzip
+import hashlib
+import json
+import time
+from cStringIO import StringIO
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+from caches import LocalCache
+from models import CatalogChunk
+from models import CatalogVersion
+from models import Conference
+
+# conference writes within one window share a single rebuild task
+CATALOG_WINDOW = 30
+CATALOG_CHUNK_SIZE = 100
+POINTER_KEY = ndb.Key(CatalogVersion, 'current')
+MEMCACHE_CATALOG_POINTER_KEY = "CATALOG:current"
+MEMCACHE_CATALOG_CHUNK_TPL = "CATALOG:%s:%d"
+# the pointer is what moves visitors to a new version; pages never change
+# once written, so browsers and the edge cache may keep them for a year
+POINTER_MAX_AGE = 60
+CHUNK_MAX_AGE = 365 * 24 * 3600
+
+# per-instance copies, so a busy instance serves both from memory
+_POINTER = LocalCache(ttl=10, maxSize=1)
+_CHUNKS = LocalCache(ttl=3600, maxSize=50)
+
+
+def _taskName(window):
+    return 'catalog-%d' % window
+
+
+def enqueueRebuildAsync():
+    """Schedule a rebuild at the end of the current window.
+
+    Returns an RPC for checkRebuildRpc. Every conference write in the same
+    window asks for the same task name, so a burst of edits costs one
+    rebuild.
+    """
+    now = time.time()
+    window = int(now) // CATALOG_WINDOW
+    task = taskqueue.Task(name=_taskName(window),
+                          url='/tasks/build_catalog',
+                          countdown=(window + 1) * CATALOG_WINDOW - now + 1)
+    return taskqueue.Queue().add_async(task)
+
+
+def checkRebuildRpc(rpc):
+    """Wait for enqueueRebuildAsync; a task for the window may exist."""
+    try:
+        rpc.get_result()
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _chunkKey(version, page):
+    return ndb.Key(CatalogChunk, '%s-%d' % (version, page))
+
+
+def _gzip(data):
+    out = StringIO()
+    # a fixed mtime keeps the bytes of unchanged pages identical
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as gz:
+        gz.write(data)
+    return out.getvalue()
+
+
+def gunzip(data):
+    """Return the uncompressed bytes of a gzipped page."""
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+def _pointerDict(pointer):
+    return {'version': pointer.version, 'chunks': pointer.chunks,
+            'count': pointer.count, 'chunkSize': CATALOG_CHUNK_SIZE}
+
+
+def _catalogItems():
+    """Return the unfiltered queryConferences result as JSON dicts."""
+    # conference.py imports this module to schedule rebuilds
+    from conference import ConferenceApi
+    api = ConferenceApi()
+    conferences = [conf for conf in
+                   Conference.query().order(Conference.name)
+                   if not conf.deleted]
+    names = api._getDisplayNames(conferences)
+    seats = api._getSeatsAvailable(conferences)
+    return [json.loads(protojson.encode_message(api._copyConferenceToForm(
+        conf, names.get(conf.organizerUserId), seats[conf.key])))
+        for conf in conferences]
+
+
+def buildSnapshot():
+    """Write a new catalog version if the catalog changed; return it.
+
+    The version is a hash of the content, so a rebuild that finds nothing
+    new keeps every cached page valid. Pages are written before the
+    pointer moves to them, and the previous version is kept for visitors
+    still paging through it.
+    """
+    items = _catalogItems()
+    pages = [json.dumps({'items': items[i:i + CATALOG_CHUNK_SIZE]},
+                        separators=(',', ':'), sort_keys=True)
+             for i in range(0, len(items) or 1, CATALOG_CHUNK_SIZE)]
+    version = hashlib.sha1(''.join(pages)).hexdigest()[:12]
+
+    pointer = POINTER_KEY.get()
+    if pointer and pointer.version == version:
+        return _pointerDict(pointer)
+    ndb.put_multi([CatalogChunk(key=_chunkKey(version, page),
+                                version=version, data=_gzip(data))
+                   for page, data in enumerate(pages)])
+    previous = pointer.version if pointer else None
+    pointer = CatalogVersion(key=POINTER_KEY, version=version,
+                             previous=previous, chunks=len(pages),
+                             count=len(items))
+    pointer.put()
+    memcache.set(MEMCACHE_CATALOG_POINTER_KEY, _pointerDict(pointer))
+
+    # drop pages of every version older than the previous one
+    keep = (version, previous)
+    ndb.delete_multi([key for key in CatalogChunk.query().iter(
+        keys_only=True) if key.id().rsplit('-', 1)[0] not in keep])
+    return _pointerDict(pointer)
+
+
+def getPointer():
+    """Return the current version pointer dict, or None before a build."""
+    pointer = _POINTER.get('current')
+    if pointer is None:
+        pointer = memcache.get(MEMCACHE_CATALOG_POINTER_KEY)
+        if pointer is None:
+            entity = POINTER_KEY.get()
+            if entity is None:
+                return None
+            pointer = _pointerDict(entity)
+            memcache.set(MEMCACHE_CATALOG_POINTER_KEY, pointer)
+        _POINTER.set('current', pointer)
+    return pointer
+
+
+def getChunk(version, page):
+    """Return the gzipped page of a catalog version, or None."""
+    key = MEMCACHE_CATALOG_CHUNK_TPL % (version, page)
+    data = _CHUNKS.get(key)
+    if data is None:
+        data = memcache.get(key)
+        if data is None:
+            chunk = _chunkKey(version, page).get()
+            if chunk is None:
+                return None
+            data = chunk.data
+            memcache.set(key, data)
+        _CHUNKS.set(key, data)
+    return data
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+confcalendar.py -- Udacity conference server-side Python App Engine
+    calendar of conferences by date range, served from per-month buckets
+    cached in memcache and patched in place by conference writes
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+from google.appengine.api import memcache
+
+from models import Conference
+from utils import activeMonths
+
+MEMCACHE_CALENDAR_TPL = "CALENDAR:%d"
+# bounds how long writes that don't patch the buckets (organizer renames,
+# migrations) can stay invisible
+MEMCACHE_CALENDAR_SECONDS = 6 * 3600
+# a write holds the months it could not patch this long, which covers
+# readers that queried before it committed and queries still lagging it
+MEMCACHE_CALENDAR_HOLD_SECONDS = 30
+# cached in place of a held month's bucket
+HELD = 'held'
+CAS_RETRIES = 3
+
+
+def _entries(confs):
+    """Return bucket entries, ConferenceForm fields as a dict, of confs."""
+    # conference.py imports this module to patch the buckets
+    from conference import ConferenceApi
+    api = ConferenceApi()
+    names = api._getDisplayNames(confs)
+    entries = []
+    for conf in confs:
+        form = api._copyConferenceToForm(conf, names.get(
+            conf.organizerUserId))
+        # seats change with every registration; the conference page
+        # shows the live count
+        form.seatsAvailable = None
+        entry = {}
+        for field in form.all_fields():
+            value = getattr(form, field.name)
+            # _copyConferenceToForm writes a missing date as 'None'
+            if value in (None, [], 'None'):
+                continue
+            entry[field.name] = list(value) if field.repeated else value
+        entries.append(entry)
+    return entries
+
+
+def _sortKey(entry):
+    return (entry.get('startDate'), entry.get('name'))
+
+
+def _buildBucket(month):
+    """Query the conferences running in a month; return its bucket."""
+    confs = [conf for conf in Conference.query(
+        Conference.activeMonths == month) if not conf.deleted]
+    return sorted(_entries(confs), key=_sortKey)
+
+
+def getBuckets(months):
+    """Return {month: bucket} for months, building the missing ones."""
+    keys = dict((MEMCACHE_CALENDAR_TPL % month, month) for month in months)
+    cached = memcache.get_multi(keys.keys())
+    buckets = dict((keys[key], bucket) for key, bucket in cached.items()
+                   if bucket != HELD)
+    built = {}
+    for month in months:
+        if month not in buckets:
+            buckets[month] = built[MEMCACHE_CALENDAR_TPL % month] = (
+                _buildBucket(month))
+    if built:
+        # add, not set: it fails for held months, and for buckets a write
+        # has patched meanwhile
+        memcache.add_multi(built, time=MEMCACHE_CALENDAR_SECONDS)
+    return buckets
+
+
+def _months(conf):
+    if conf is None or conf.deleted:
+        return []
+    return conf.activeMonths or activeMonths(conf.startDate, conf.endDate)
+
+
+def updateBuckets(before, after):
+    """Patch the cached buckets of a conference going before -> after.
+
+    Buckets that are not cached are held instead, so a reader that built
+    one before the write can't cache it; the first read after the hold
+    builds it from the datastore.
+    """
+    conf = after or before
+    wsck = conf.key.urlsafe()
+    old = set(_months(before))
+    new = set(_months(after))
+    entry = _entries([after])[0] if new else None
+    client = memcache.Client()
+    for month in old | new:
+        key = MEMCACHE_CALENDAR_TPL % month
+        for attempt in range(CAS_RETRIES):
+            bucket = client.gets(key)
+            if bucket is None:
+                if client.add(key, HELD, time=MEMCACHE_CALENDAR_HOLD_SECONDS):
+                    break
+                # a reader cached its bucket meanwhile; patch that
+                continue
+            if bucket == HELD:
+                client.set(key, HELD, time=MEMCACHE_CALENDAR_HOLD_SECONDS)
+                break
+            bucket = [item for item in bucket
+                      if item.get('websafeKey') != wsck]
+            if month in new:
+                bucket.append(entry)
+                bucket.sort(key=_sortKey)
+            if client.cas(key, bucket, time=MEMCACHE_CALENDAR_SECONDS):
+                break
+        else:
+            # lost every race with other writers; rebuild after the hold
+            client.set(key, HELD, time=MEMCACHE_CALENDAR_HOLD_SECONDS)
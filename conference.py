@@ -9,17 +9,40 @@ created by wesc on 2014 apr 21
 
 __authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
 
+import json
+import logging
+from datetime import date
 from datetime import datetime
+from datetime import timedelta
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
+from caches import ANNOUNCEMENT_CACHE
+from caches import FEATURED_CACHE
+from caches import ORGANIZER_NAMES
+
+import catalog
+import confcalendar
+import facets
+import profilecache
+import profiling
+import purge
+import recommend
+import speakercounts
+import stats
+import txstats
+import waitlist
+
+from models import BatchRequest
+from models import BatchResponse
+from models import BatchSubResponse
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
@@ -28,27 +51,49 @@ from models import StringMessage
 from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
+from models import ConferenceSeats
+from models import ConferenceStatsForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceFacetsForm
+from models import FacetCountForm
 from models import TeeShirtSize
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionCountForm
 from models import TypeOfSession
 from models import Speaker
 from models import SpeakerForm
+from models import TopSpeakerForm
+from models import TopSpeakersForm
+from models import WaitlistForm
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import CONFERENCE_KEY_LAYOUT
 
+from outbox import enqueueConfirmation
+from outbox import formatConference
+
+from ratelimit import rateLimited
+from rekey import ROOT_LAYOUT
+from rekey import isWebsafeKey
+from rekey import newConferenceKey
+from rekey import resolveKey
+from rekey import resolveKeys
+
+from utils import activeMonths
 from utils import getUserId
+from utils import sessionTimeFields
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_FEATURED_TPL = "FEATURED:%s"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -85,6 +130,32 @@ FIELDS = {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+# Fields whose inequality filters may only be used on their own; the index
+# set in index.yaml (see tools/index_cost.py) only pairs the numeric fields
+# with other filters.
+STANDALONE_INEQUALITY_FIELDS = ('city', 'topics')
+
+# read-only methods a batch may call; writes keep their own round trip so
+# their errors and retries stay per call
+BATCH_METHODS = (
+    'getAnnouncement',
+    'getConference',
+    'getConferenceCalendar',
+    'getConferenceSessions',
+    'getConferenceSessionsByType',
+    'getConferenceStats',
+    'getConferencesToAttend',
+    'getFeaturedSpeaker',
+    'getProfile',
+    'getRecommendedSessions',
+    'getSessionsInWishlist',
+)
+BATCH_MAX_REQUESTS = 20
+TOP_SPEAKERS_PAGE_SIZE = 20
+TOP_SPEAKERS_MAX_PAGE_SIZE = 100
+CALENDAR_DEFAULT_DAYS = 30
+CALENDAR_MAX_MONTHS = 12
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -110,11 +181,39 @@ SESS_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESS_TIME_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    endTime=messages.StringField(2),
+)
+
 SESS_WISHL_POST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSessionKey=messages.StringField(1),
 )
 
+SESS_DEL_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKey=messages.StringField(1),
+)
+
+SESS_REC_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKey=messages.StringField(1),
+)
+
+CALENDAR_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    startDate=messages.StringField(1),
+    endDate=messages.StringField(2),
+)
+
+TOP_SPEAKERS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    limit=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -126,8 +225,16 @@ class ConferenceApi(remote.Service):
 
 # - - - Session objects - - - - - - - - - - - - - - - - -
 
-    def _copySessionToForm(self, sess):
+    def _copySessionToForm(self, sess, speakerNames=None):
         """Copy relevant fields from Session to SessionForm."""
+        # speaker names by key; fetch whatever the caller didn't supply in
+        # one batch instead of one get per speaker
+        speakerNames = dict(speakerNames or {})
+        missing = [s for s in sess.speakers if s not in speakerNames]
+        if missing:
+            for spkr in ndb.get_multi(missing):
+                if spkr:
+                    speakerNames[spkr.key] = spkr.name
         sf = SessionForm()
         for field in sf.all_fields():
             if hasattr(sess, field.name):
@@ -147,7 +254,8 @@ class ConferenceApi(remote.Service):
                 # convert Speaker keys as list to strings as a list
                 elif field.name == 'speakers':
                     setattr(sf, field.name,
-                            [str(s.get().name) for s in sess.speakers])
+                            [str(speakerNames[s]) for s in sess.speakers
+                             if s in speakerNames])
                 # just copy the other fields
                 else:
                     setattr(sf, field.name, getattr(sess, field.name))
@@ -158,6 +266,21 @@ class ConferenceApi(remote.Service):
         sf.check_initialized()
         return sf
 
+    def _copySessionsToForms(self, sessions):
+        """Return SessionForms for sessions, reading all speakers at once."""
+        spkr_keys = list(set(s for sess in sessions for s in sess.speakers))
+        speakerNames = dict((spkr.key, spkr.name) for spkr in
+                            ndb.get_multi(spkr_keys) if spkr)
+        return SessionForms(items=[self._copySessionToForm(
+            sess, speakerNames) for sess in sessions])
+
+    @staticmethod
+    def _speakerKey(name):
+        """Return the Speaker key for a speaker name."""
+        # The speaker string value is put in lowercase with no
+        # whitespaces for the key name, so the keys are known up front.
+        return ndb.Key(Speaker, name.lower().strip().replace(" ", "_"))
+
     def _createSessionObject(self, request):
         """
         Creates Session object, returning a variation of the
@@ -169,9 +292,9 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
         # convert websafeKey to a conference key
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = resolveKey(request.websafeConferenceKey).get()
         # check that conference exists
-        if not conf:
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
                 % request.websafeConferenceKey)
@@ -183,6 +306,11 @@ class ConferenceApi(remote.Service):
         if not request.name:
             raise endpoints.BadRequestException("Session 'name' field \
                 required")
+        # get Conference key
+        c_key = conf.key
+        # designate new Session ID with the Conference key as a parent;
+        # the allocation runs while the request is being converted
+        s_id_future = Session.allocate_ids_async(size=1, parent=c_key)
         # copy SessionForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in
                 request.all_fields()}
@@ -211,52 +339,69 @@ class ConferenceApi(remote.Service):
             data['duration'] = datetime.strptime(data['duration'][:5],
                                                  "%H:%M").time()
         # convert speakers from strings as list to Speaker entity keys as list
+        speakerNames = {}
         if data['speakers']:
-            # Check that each provided speaker for a session exists in the
-            # database. If the speaker exists in the database, then retrieve
-            # the key value. Otherwise, make a new speaker having the provided
-            # name as the key.
             speakersForSession = []
             for speaker in data['speakers']:
-                # The function get_or_insert(key_name, args) gets as a
-                # transaction an existing entity or it makes a new entity,
-                # which eliminates the problem of duplicate speakers when
-                # multiple sessions that have the same speaker are formed
-                # during the same time. The speaker string value is put in
-                # lowercase with no whitespaces for the key name.
-                spkr_for_sess_key = Speaker.get_or_insert(
-                    speaker.lower().strip().replace(" ", "_"),
-                    name=speaker).key
-                # add speaker for session key to speakersForSession list
-                speakersForSession.append(spkr_for_sess_key)
+                spkr_key = self._speakerKey(speaker)
+                if spkr_key not in speakerNames:
+                    speakersForSession.append(spkr_key)
+                    speakerNames[spkr_key] = speaker
+            # Existing speakers are found with one batch get. Only the
+            # missing ones go through get_or_insert, which gets as a
+            # transaction an existing entity or makes a new entity, so
+            # sessions formed at the same time never duplicate a speaker.
+            # Those transactions run concurrently.
+            inserts = []
+            for spkr_key, spkr in zip(speakersForSession,
+                                      ndb.get_multi(speakersForSession)):
+                if spkr:
+                    speakerNames[spkr_key] = spkr.name
+                else:
+                    inserts.append(Speaker.get_or_insert_async(
+                        spkr_key.id(), name=speakerNames[spkr_key]))
+            for future in inserts:
+                spkr = future.get_result()
+                speakerNames[spkr.key] = spkr.name
             # update data['speakers'] with newly formed list of keys
             data['speakers'] = speakersForSession
+        # store start and end as integers so time ranges can be indexed
+        data.update(sessionTimeFields(data['date'], data['startTime'],
+                                      data['duration']))
 
-        # get Conference key
-        c_key = conf.key
-        # designate new Session ID with the Conference key as a parent
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
         # create key for new Session having Conference key as a parent
-        s_key = ndb.Key(Session, s_id, parent=c_key)
+        s_key = ndb.Key(Session, s_id_future.get_result()[0], parent=c_key)
         # put key into dict
         data['key'] = s_key
-        # create a Session
-        Session(**data).put()
-        # allows for the session to be copied back to form
-        sess = s_key.get()
-        # reviews speakers for conference when task is added to queue
-        taskqueue.add(params={'c_key_str': c_key.urlsafe()},
-                      url='/tasks/review_speakers_for_sessions')
-        return self._copySessionToForm(sess)
+        # create a Session; the form is built from this entity, so there
+        # is no need to read it back
+        sess = Session(**data)
+        put_future = sess.put_async()
+        # the speakers' other sessions here are counted alongside the put
+        deltas = speakercounts.conferenceDeltasAsync(
+            c_key, speakercounts.sessionDeltas([sess], 1), [s_key])
+        # the conference's stats are recomputed once per window
+        stats_rpc = stats.enqueueRecomputeAsync(c_key)
+        put_future.get_result()
+        # reviews speakers for conference and counts the session for its
+        # speakers when the tasks are added to queue; the review queries
+        # the conference's sessions, so it is only added once the session
+        # is stored
+        taskqueue.Queue().add([
+            taskqueue.Task(params={'c_key_str': c_key.urlsafe()},
+                           url='/tasks/review_speakers_for_sessions'),
+            speakercounts.updateTask(deltas.get_result())])
+        stats.checkRecomputeRpc(stats_rpc)
+        return self._copySessionToForm(sess, speakerNames)
 
     def _getConferenceSessions(self, request):
         """
         This function returns all sessions for an existing conference.
         """
         # convert websafeKey to a conference key
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = resolveKey(request.websafeConferenceKey).get()
         # check that conference exists
-        if not conf:
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
                 % request.websafeConferenceKey)
@@ -274,23 +419,18 @@ class ConferenceApi(remote.Service):
         if not request.name:
             raise endpoints.BadRequestException("Speaker 'name' field \
                 required")
-        # creates new key for Speaker
-        spkr_key = Speaker().key
-        # for all noted speakers, make a query
-        notedSpeakersQuery = Speaker.query()
-        # lists noted speakers
-        notedSpeakers = []
-        for ns in notedSpeakersQuery:
-            notedSpeakers.append(ns.name)
+        # Speakers are keyed by their normalized name, so this is a
+        # single get instead of a scan of every Speaker; the name query
+        # only runs for a name stored with different spelling.
+        spkr = self._speakerKey(request.name).get()
+        if not spkr or spkr.name != request.name:
+            spkr = Speaker.query(Speaker.name == request.name).get()
         # When no speaker is found with a name, a NotFoundException is raised.
-        if request.name not in notedSpeakers:
+        if not spkr:
             raise endpoints.NotFoundException(
                 'No speaker found with name: %s'
                 % request.name)
-        # Otherwise, have its key returned.
-        else:
-            spkr_key = Speaker.query(Speaker.name == request.name).get().key
-        return spkr_key
+        return spkr.key
 
     @endpoints.method(SESS_POST_REQUEST, SessionForm,
                       path='conference/{websafeConferenceKey}/sessions',
@@ -299,21 +439,58 @@ class ConferenceApi(remote.Service):
         """Creates new conference session."""
         return self._createSessionObject(request)
 
+    @endpoints.method(SESS_DEL_REQUEST, BooleanMessage,
+                      path='session/{websafeSessionKey}',
+                      http_method='DELETE', name='deleteSession')
+    def deleteSession(self, request):
+        """Delete a conference session; only the organizer may."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        wssk = request.websafeSessionKey
+        s_key = resolveKey(wssk)
+        if s_key.kind() != Session._get_kind():
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % wssk)
+        # the session and its conference are read in one batch
+        sess, conf = ndb.get_multi([s_key, s_key.parent()])
+        if not sess or not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % wssk)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'The conference can only be changed by the owner.')
+        delete_future = s_key.delete_async()
+        deltas = speakercounts.conferenceDeltasAsync(
+            conf.key, speakercounts.sessionDeltas([sess], -1), [s_key])
+        delete_future.get_result()
+        # wishlists are pruned in the background; featured speakers,
+        # speaker counters and stats are recomputed without the session
+        taskqueue.Queue().add([
+            taskqueue.Task(params={'s_key_str': s_key.urlsafe()},
+                           url='/tasks/prune_wishlists'),
+            taskqueue.Task(params={'c_key_str': conf.key.urlsafe()},
+                           url='/tasks/review_speakers_for_sessions'),
+            speakercounts.updateTask(deltas.get_result())])
+        stats.checkRecomputeRpc(stats.enqueueRecomputeAsync(conf.key))
+        return BooleanMessage(data=True)
+
     @endpoints.method(SESS_GET_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions',
                       http_method='GET', name='_getConferenceSessions')
+    @rateLimited('getConferenceSessions')
     def getConferenceSessions(self, request):
         """Return all sessions for an existing conference."""
         sessions = self._getConferenceSessions(request)
         # For each Session, a group of SessionForm objects are returned.
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-        )
+        return self._copySessionsToForms(sessions.fetch())
 
     @endpoints.method(
         SESS_TYPE_GET_REQUEST, SessionForms,
         path='conference/{websafeConferenceKey}/sessions/byType',
         http_method='GET', name='getConferenceSessionsByType')
+    @rateLimited('getConferenceSessionsByType')
     def getConferenceSessionsByType(self, request):
         """Return all sessions by filtered type for an existing conference."""
         sessions = self._getConferenceSessions(request)
@@ -321,13 +498,61 @@ class ConferenceApi(remote.Service):
         sessions = sessions.filter(
             Session.typeOfSession == str(request.typeOfSession))
         # For each Session, a group of SessionForm objects are returned.
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-        )
+        return self._copySessionsToForms(sessions.fetch())
+
+    @endpoints.method(
+        SESS_TIME_GET_REQUEST, SessionForms,
+        path='conference/{websafeConferenceKey}/sessions/endingBefore',
+        http_method='GET', name='getConferenceSessionsEndingBefore')
+    def getConferenceSessionsEndingBefore(self, request):
+        """Return sessions of a conference that end by the given HH:MM."""
+        if not request.endTime:
+            raise endpoints.BadRequestException("'endTime' field required")
+        try:
+            endTime = datetime.strptime(request.endTime[:5], "%H:%M").time()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "'endTime' must be formatted as HH:MM")
+        sessions = self._getConferenceSessions(request)
+        # the range is served by the (ancestor, endMinutes) index
+        sessions = sessions.filter(
+            Session.endMinutes <= endTime.hour * 60 + endTime.minute)
+        sessions = sessions.order(Session.endMinutes)
+        # For each Session, a group of SessionForm objects are returned.
+        return self._copySessionsToForms(sessions.fetch())
+
+    @endpoints.method(
+        SESS_GET_REQUEST, ConferenceStatsForm,
+        path='conference/{websafeConferenceKey}/stats',
+        http_method='GET', name='getConferenceStats')
+    def getConferenceStats(self, request):
+        """Return session statistics for an existing conference."""
+        c_key = resolveKey(request.websafeConferenceKey)
+        # a single get; stats are only computed here for conferences
+        # whose stats were never written
+        conf_stats = stats.statsKey(c_key).get()
+        if conf_stats is None:
+            conf_stats = stats.recompute(c_key)
+        if conf_stats is None:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s'
+                % request.websafeConferenceKey)
+        return ConferenceStatsForm(
+            sessionCount=conf_stats.sessionCount,
+            sessionsByType=[
+                SessionCountForm(value=value, count=count) for value, count
+                in sorted((conf_stats.sessionsByType or {}).items())],
+            sessionsByDay=[
+                SessionCountForm(value=value, count=count) for value, count
+                in sorted((conf_stats.sessionsByDay or {}).items())],
+            speakerCount=conf_stats.speakerCount,
+            totalMinutes=conf_stats.totalMinutes,
+            websafeConferenceKey=c_key.urlsafe())
 
     @endpoints.method(SpeakerForm, SessionForms,
                       path='sessions/bySpeaker',
                       http_method='GET', name='getSessionsBySpeaker')
+    @rateLimited('getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
         """Return all sessions for an existing speaker."""
         # obtain key of speaker requested
@@ -335,16 +560,15 @@ class ConferenceApi(remote.Service):
         # For all sessions for provided speaker, make a query.
         sessions = Session.query(Session.speakers == spkr_key)
         # For each Session, a group of SessionForm objects are returned.
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-        )
+        return self._copySessionsToForms(sessions.fetch())
 
     @endpoints.method(SESS_WISHL_POST_REQUEST, BooleanMessage,
                       path='wishlist', http_method='POST',
                       name='addSessionToWishlist')
-    @ndb.transactional
+    @txstats.transactional('addSessionToWishlist', xg=True)
     # To eliminate problems of losing a session when multiple sessions are
-    # added, we allow for the function to be transactional.
+    # added, we allow for the function to be transactional. The profile and
+    # the session are in different entity groups.
     def addSessionToWishlist(self, request):
         """Put an existing session on the user's wishlist."""
         onWishlist = None
@@ -353,11 +577,13 @@ class ConferenceApi(remote.Service):
         # Provided the websafeSession key is available, check that session
         # exists on wishlist.
         wssk = request.websafeSessionKey
-        sess = ndb.Key(urlsafe=wssk).get()
+        sess = resolveKey(wssk).get()
         # When no session is found with key, a NotFoundException is raised.
         if not sess:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % wssk)
+        # old websafe keys are stored as the current one
+        wssk = sess.key.urlsafe()
         # check that session exists on wishlist
         if wssk in prof.wishlistSessionsKeys:
             raise ConflictException(
@@ -367,8 +593,31 @@ class ConferenceApi(remote.Service):
         onWishlist = True
         # write the added session back to datastore and then returns
         prof.put()
+        profilecache.invalidate(prof.key)
         return BooleanMessage(data=onWishlist)
 
+    @endpoints.method(SESS_REC_GET_REQUEST, SessionForms,
+                      path='session/{websafeSessionKey}/recommended',
+                      http_method='GET', name='getRecommendedSessions')
+    def getRecommendedSessions(self, request):
+        """Return sessions most often wishlisted with the given one."""
+        wssk = request.websafeSessionKey
+        s_key = resolveKey(wssk)
+        if s_key.kind() != Session._get_kind():
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % wssk)
+        c_key = s_key.parent()
+        # the nightly job keeps one table per conference
+        recs = recommend.recommendationsKey(c_key).get()
+        neighbours = []
+        if recs and recs.neighbours:
+            neighbours = recs.neighbours.get(str(s_key.id()), [])
+        sessions = [sess for sess in ndb.get_multi(
+            [ndb.Key(Session, s_id, parent=c_key) for s_id, count in
+             neighbours]) if sess]
+        # speakers of all the sessions are read in one batch
+        return self._copySessionsToForms(sessions)
+
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='wishlist',
                       http_method='GET', name='getSessionsInWishlist')
@@ -377,13 +626,11 @@ class ConferenceApi(remote.Service):
         # obtains user profile
         prof = self._getProfileFromUser()
         # obtain the wishlistSessionsKeys from the profile
-        sess_keys = [ndb.Key(urlsafe=wssk) for wssk in
-                     prof.wishlistSessionsKeys]
+        sess_keys = resolveKeys(prof.wishlistSessionsKeys)
         # from datastore, fetch sessions
         sessions = ndb.get_multi(sess_keys)
         # For each Session, a group of SessionForm objects are returned.
-        return SessionForms(items=[self._copySessionToForm(sess) for sess in
-                            sessions])
+        return self._copySessionsToForms([sess for sess in sessions if sess])
 
 # - - - Two Additional Queries - - - - - - - - - - - - - - -
 
@@ -393,10 +640,13 @@ class ConferenceApi(remote.Service):
     def getMinAttndsConfs(self, request):
         """Gets list of all conferences that have the least attendees."""
         # query for minimum attendees of all the conferences
-        q = Conference.query(Conference.maxAttendees <= 5)
+        q = [conf for conf in Conference.query(
+            Conference.maxAttendees <= 5) if not conf.deleted]
+        seats = self._getSeatsAvailable(q)
+        names = self._getDisplayNames(q)
         # conference data for ConferenceForms
-        items = [self._copyConferenceToForm(conf, getattr(
-            conf.key.parent().get(), 'displayName')) for conf in q]
+        items = [self._copyConferenceToForm(conf, names.get(
+            conf.organizerUserId), seats[conf.key]) for conf in q]
         # A group of ConferenceForm objects are returned.
         return ConferenceForms(items=items)
 
@@ -406,16 +656,33 @@ class ConferenceApi(remote.Service):
     def getMaxAttndsConfs(self, request):
         """Gets list of all conferences that have the most attendees."""
         # query for maximum attendees of all the conferences
-        q = Conference.query(Conference.maxAttendees >= 100)
+        q = [conf for conf in Conference.query(
+            Conference.maxAttendees >= 100) if not conf.deleted]
+        seats = self._getSeatsAvailable(q)
+        names = self._getDisplayNames(q)
         # conference data for ConferenceForms
-        items = [self._copyConferenceToForm(conf, getattr(
-            conf.key.parent().get(), 'displayName')) for conf in q]
+        items = [self._copyConferenceToForm(conf, names.get(
+            conf.organizerUserId), seats[conf.key]) for conf in q]
         # A group of ConferenceForm objects are returned.
         return ConferenceForms(items=items)
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
+    @staticmethod
+    def _seatsKey(c_key):
+        """Return the key of a conference's seat inventory."""
+        return ndb.Key(ConferenceSeats, 1, parent=c_key)
+
+    @staticmethod
+    def _getSeatsAvailable(confs):
+        """Return seatsAvailable by conference key, in one batch get."""
+        seats = ndb.get_multi([ConferenceApi._seatsKey(conf.key) for conf in
+                               confs])
+        # conferences without an inventory yet still carry their own count
+        return dict((conf.key, s.seatsAvailable if s else conf.seatsAvailable)
+                    for conf, s in zip(confs, seats))
+
+    def _copyConferenceToForm(self, conf, displayName, seatsAvailable=None):
         """Copy relevant fields from Conference to ConferenceForm."""
         cf = ConferenceForm()
         for field in cf.all_fields():
@@ -429,6 +696,8 @@ class ConferenceApi(remote.Service):
                 setattr(cf, field.name, conf.key.urlsafe())
         if displayName:
             setattr(cf, 'organizerDisplayName', displayName)
+        if seatsAvailable is not None:
+            setattr(cf, 'seatsAvailable', seatsAvailable)
         cf.check_initialized()
         return cf
 
@@ -451,7 +720,6 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in
                 request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
 
         """
         Add default values for those missing
@@ -478,6 +746,8 @@ class ConferenceApi(remote.Service):
         if data['endDate']:
             data['endDate'] = datetime.strptime(data['endDate'][:10],
                                                 "%Y-%m-%d").date()
+        data['activeMonths'] = activeMonths(data['startDate'],
+                                            data['endDate'])
 
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
@@ -487,21 +757,35 @@ class ConferenceApi(remote.Service):
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
+        c_key = newConferenceKey(p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
+        # store the organizer's name so listings never read the Profile
+        prof = profilecache.getProfile(p_key)
+        data['organizerDisplayName'] = request.organizerDisplayName = (
+            prof.displayName if prof else user.nickname())
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                      'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
+        conf = Conference(**data)
+        self._storeNewConference(conf, data['seatsAvailable'])
+        # add the new conference to the cached calendar months
+        confcalendar.updateBuckets(None, conf)
+        # the notice waits in the mail outbox and is sent in a batch
+        enqueueConfirmation(user.email(), formatConference(request))
         return request
 
-    @ndb.transactional()
+    @txstats.transactional('createConference')
+    def _storeNewConference(self, conf, seatsAvailable):
+        """Store a new conference and count it under its facet values."""
+        # registrations only ever write the small seat inventory entity
+        ndb.put_multi([conf, ConferenceSeats(
+            key=self._seatsKey(conf.key), seatsAvailable=seatsAvailable)])
+        # enqueued with the put, so the counts can't miss the conference
+        facets.enqueueUpdate(facets.facetDeltas(None, conf),
+                             transactional=True)
+
+    @txstats.transactional('updateConference')
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -515,7 +799,7 @@ class ConferenceApi(remote.Service):
         # update existing conference
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         # check that conference exists
-        if not conf:
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
                 % request.websafeConferenceKey)
@@ -524,10 +808,15 @@ class ConferenceApi(remote.Service):
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
+        # keep the old values around to move the facet counts
+        before = Conference(**conf.to_dict())
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            # the organizer fields are maintained by the server
+            if field.name in ('organizerUserId', 'organizerDisplayName'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -538,22 +827,90 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        conf.activeMonths = activeMonths(conf.startDate, conf.endDate)
+        # seat changes go to the inventory, which lives in the same group
+        seats = self._seatsKey(conf.key).get()
+        if request.seatsAvailable is not None or seats is None:
+            seats = seats or ConferenceSeats(key=self._seatsKey(conf.key))
+            seats.seatsAvailable = conf.seatsAvailable
+            seats.put()
+            # added seats go to the waitlist first
+            waitlist.enqueuePromotion(conf.key, transactional=True)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        facets.enqueueUpdate(facets.facetDeltas(before, conf),
+                             transactional=True)
+        # the cached calendar months are patched once the write is in
+        ndb.get_context().call_on_commit(
+            lambda: confcalendar.updateBuckets(before, conf))
+        return self._copyConferenceToForm(conf, None, seats.seatsAvailable)
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
     def createConference(self, request):
         """Create new conference."""
-        return self._createConferenceObject(request)
+        catalog_rpc = catalog.enqueueRebuildAsync()
+        form = self._createConferenceObject(request)
+        catalog.checkRebuildRpc(catalog_rpc)
+        return form
 
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        # follow a redirect before the transaction; it is another group
+        request.websafeConferenceKey = resolveKey(
+            request.websafeConferenceKey).urlsafe()
+        form = self._updateConferenceObject(request)
+        catalog.checkRebuildRpc(catalog.enqueueRebuildAsync())
+        return form
+
+    @txstats.transactional('deleteConference')
+    def _deleteConferenceObject(self, request):
+        """Mark a conference deleted and start purging it."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        # check that conference exists
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s'
+                % request.websafeConferenceKey)
+        # check that user is owner
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+        before = Conference(**conf.to_dict())
+        conf.deleted = True
+        conf.put()
+        # the conference leaves the facet counts now; its sessions and the
+        # profile references to it are removed by the purge task
+        facets.enqueueUpdate(facets.facetDeltas(before, conf),
+                             transactional=True)
+        purge.enqueuePurge(conf.key, transactional=True)
+        ndb.get_context().call_on_commit(
+            lambda: confcalendar.updateBuckets(before, conf))
+        return conf
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/delete',
+                      http_method='POST', name='deleteConference')
+    def deleteConference(self, request):
+        """Delete a conference and its sessions; only the owner may."""
+        # follow a redirect before the transaction; it is another group
+        request.websafeConferenceKey = resolveKey(
+            request.websafeConferenceKey).urlsafe()
+        conf = self._deleteConferenceObject(request)
+        catalog_rpc = catalog.enqueueRebuildAsync()
+        # drop the cached featured speakers and the announcement, which
+        # may name the conference
+        FEATURED_CACHE.delete(MEMCACHE_FEATURED_TPL % conf.key.urlsafe())
+        self._cacheAnnouncement()
+        catalog.checkRebuildRpc(catalog_rpc)
+        return BooleanMessage(data=True)
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
@@ -561,15 +918,58 @@ class ConferenceApi(remote.Service):
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        conf = resolveKey(request.websafeConferenceKey).get()
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
                 % request.websafeConferenceKey)
 
-        prof = conf.key.parent().get()
+        names = self._getDisplayNames([conf])
+        seats = self._seatsKey(conf.key).get()
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(
+            conf, names.get(conf.organizerUserId),
+            seats.seatsAvailable if seats else None)
+
+    @endpoints.method(CALENDAR_GET_REQUEST, ConferenceForms,
+                      path='conferences/calendar', http_method='GET',
+                      name='getConferenceCalendar')
+    def getConferenceCalendar(self, request):
+        """Return conferences running between startDate and endDate,
+        by default the next 30 days, ordered by start date."""
+        try:
+            start = (datetime.strptime(request.startDate[:10],
+                                       "%Y-%m-%d").date()
+                     if request.startDate else date.today())
+            end = (datetime.strptime(request.endDate[:10], "%Y-%m-%d").date()
+                   if request.endDate else
+                   start + timedelta(days=CALENDAR_DEFAULT_DAYS))
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Dates must be given as YYYY-MM-DD')
+        if end < start:
+            raise endpoints.BadRequestException(
+                'endDate must not be before startDate')
+        months = activeMonths(start, end)
+        if len(months) > CALENDAR_MAX_MONTHS:
+            raise endpoints.BadRequestException(
+                'The calendar spans at most %d months' % CALENDAR_MAX_MONTHS)
+        # every month is one memcache entry, so moving through the
+        # calendar only queries months no one has looked at yet
+        buckets = confcalendar.getBuckets(months)
+        first, last = str(start), str(end)
+        found = {}
+        for month in months:
+            for entry in buckets[month]:
+                # a bucket holds the whole month; keep the overlapping
+                # conferences, once each
+                starts = entry['startDate']
+                if starts <= last and entry.get('endDate', starts) >= first:
+                    found[entry['websafeKey']] = entry
+        return ConferenceForms(items=[
+            ConferenceForm(**entry) for entry in sorted(
+                found.values(), key=lambda entry: (entry.get('startDate'),
+                                                   entry.get('name')))])
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='getConferencesCreated', http_method='POST',
@@ -581,13 +981,23 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        if CONFERENCE_KEY_LAYOUT == ROOT_LAYOUT:
+            # root conferences are found by organizer; during a migration
+            # some may still be children of the profile
+            confs = Conference.query(
+                Conference.organizerUserId == user_id).fetch()
+        else:
+            # create ancestor query for all key matches for this user
+            confs = Conference.query(
+                ancestor=ndb.Key(Profile, user_id)).fetch()
+        # conferences waiting to be purged are left out
+        confs = [conf for conf in confs if not conf.deleted]
+        names = self._getDisplayNames(confs)
+        seats = self._getSeatsAvailable(confs)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(
-                   prof, 'displayName')) for conf in confs])
+            items=[self._copyConferenceToForm(conf, names.get(
+                   conf.organizerUserId), seats[conf.key]) for conf in confs])
 
     def _getQuery(self, request):
         """Return formatted query from the submitted filters."""
@@ -640,29 +1050,73 @@ class ConferenceApi(remote.Service):
                     inequality_field = filtr["field"]
 
             formatted_filters.append(filtr)
+
+        if inequality_field in STANDALONE_INEQUALITY_FIELDS and any(
+                filtr["field"] != inequality_field for filtr in
+                formatted_filters):
+            raise endpoints.BadRequestException("Inequality filters on city \
+                or topic cannot be combined with other filters.")
         return (inequality_field, formatted_filters)
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences', http_method='POST',
                       name='queryConferences')
+    @rateLimited('queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in
-                      conferences]
-        profiles = ndb.get_multi(organisers)
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        # run the query once; the results are used twice below.
+        # Conferences waiting to be purged are dropped here rather than
+        # in the query, which would need a second copy of every index.
+        conferences = [conf for conf in self._getQuery(request)
+                       if not conf.deleted]
+
+        # organiser displayName is stored on the conference
+        names = self._getDisplayNames(conferences)
+        seats = self._getSeatsAvailable(conferences)
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(items=[self._copyConferenceToForm(conf,
-                               names[conf.organizerUserId]) for conf in
-                               conferences])
+                               names.get(conf.organizerUserId),
+                               seats[conf.key]) for conf in conferences])
+
+    @staticmethod
+    def _getDisplayNames(confs):
+        """Return organizer names for conferences that don't store one.
+
+        Conferences created before organizerDisplayName existed fall back
+        to the Profile; for all others this does no datastore work.
+        """
+        return ConferenceApi._getOrganizerNames(list(set(
+            conf.organizerUserId for conf in confs
+            if conf.organizerDisplayName is None)))
+
+    @staticmethod
+    def _getOrganizerNames(userIds):
+        """Return organizer displayName by user ID, cached per instance."""
+        names = ORGANIZER_NAMES.get_multi(userIds)
+        missing = list(set(userIds) - set(names))
+        if missing:
+            # get all missing keys and use get_multi for speed
+            profiles = ndb.get_multi([ndb.Key(Profile, userId) for userId in
+                                      missing])
+            fetched = dict((prof.key.id(), prof.displayName) for prof in
+                           profiles if prof)
+            ORGANIZER_NAMES.set_multi(fetched)
+            names.update(fetched)
+        return names
+
+    @endpoints.method(message_types.VoidMessage, ConferenceFacetsForm,
+                      path='conferences/facets', http_method='GET',
+                      name='getConferenceFacets')
+    def getConferenceFacets(self, request):
+        """Return how many conferences have each filter value."""
+        counts = facets.getFacets()['counts']
+        cff = ConferenceFacetsForm()
+        for field in cff.all_fields():
+            setattr(cff, field.name, [
+                FacetCountForm(value=value, count=count) for value, count in
+                sorted(counts.get(field.name, {}).items())])
+        return cff
 
     @endpoints.method(CONF_GET_REQUEST, StringMessage,
                       path='conference/featured', http_method='GET',
@@ -671,13 +1125,47 @@ class ConferenceApi(remote.Service):
         """Returns featured speakers with respective sessions from memcache."""
 
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
+        conf = resolveKey(wsck).get()
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
-        MEMCACHE_CONFERENCE_KEY = "FEATURED:%s" % wsck
-        return StringMessage(data=memcache.get(
-            MEMCACHE_CONFERENCE_KEY) or "There are no featured speakers!")
+        wsck = conf.key.urlsafe()
+        MEMCACHE_CONFERENCE_KEY = MEMCACHE_FEATURED_TPL % wsck
+        # the per-instance copy spares memcache on every page view, and
+        # concurrent misses share one memcache read
+        featured = FEATURED_CACHE.get(MEMCACHE_CONFERENCE_KEY)
+        return StringMessage(data=featured or
+                             "There are no featured speakers!")
+
+    @endpoints.method(TOP_SPEAKERS_GET_REQUEST, TopSpeakersForm,
+                      path='speakers/top', http_method='GET',
+                      name='getTopSpeakers')
+    def getTopSpeakers(self, request):
+        """Return speakers by sessions across all conferences, a page at
+        a time."""
+        limit = min(request.limit or TOP_SPEAKERS_PAGE_SIZE,
+                    TOP_SPEAKERS_MAX_PAGE_SIZE)
+        # the page token is an offset into the cached leaderboard
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Invalid pageToken: %s' % request.pageToken)
+        if limit < 1 or offset < 0:
+            raise endpoints.BadRequestException(
+                'limit and pageToken must be positive')
+        board = speakercounts.leaderboard()
+        page = board[offset:offset + limit]
+        # only the names of the speakers on this page are read
+        spkrs = ndb.get_multi([ndb.Key(Speaker, row[0]) for row in page])
+        tsf = TopSpeakersForm(items=[TopSpeakerForm(
+            name=spkr.name if spkr else speakerId, sessions=sessions,
+            conferences=conferences, upcomingSessions=upcoming)
+            for (speakerId, sessions, conferences, upcoming), spkr in
+            zip(page, spkrs)])
+        if offset + limit < len(board):
+            tsf.nextPageToken = str(offset + limit)
+        return tsf
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
@@ -698,19 +1186,19 @@ class ConferenceApi(remote.Service):
 
     def _getProfileFromUser(self):
         """
-        Return user Profile from datastore, creating new one if
-        non-existent.
+        Return user Profile, from the profile cache outside transactions;
+        a new user gets a default Profile that their first write stores.
         """
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        # get Profile from datastore
+        # get Profile from the profile cache or the datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
+        profile = profilecache.getProfile(p_key)
+        # make a new Profile if not there; reads never store it
         if not profile:
             profile = Profile(
                 key=p_key,
@@ -718,23 +1206,40 @@ class ConferenceApi(remote.Service):
                 mainEmail=user.email(),
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
 
         return profile      # return Profile
 
-    def _doProfile(self, save_request=None):
-        """Get user Profile and return to user, possibly updating it first."""
-        # get user Profile
+    @txstats.transactional('saveProfile')
+    def _saveProfile(self, save_request):
+        """Update the user-modifyable fields of the stored Profile."""
+        # in a transaction this reads the datastore, never the profile
+        # cache, so registrations and wishlist entries written meanwhile
+        # on another instance are kept
         prof = self._getProfileFromUser()
+        oldName = prof.displayName
+        for field in ('displayName', 'teeShirtSize'):
+            if hasattr(save_request, field):
+                val = getattr(save_request, field)
+                if val:
+                    setattr(prof, field, str(val))
+        prof.put()
+        profilecache.invalidate(prof.key)
+        # copy a new name onto every conference the user organizes
+        if prof.displayName != oldName:
+            taskqueue.add(params={'user_id': prof.key.id()},
+                          url='/tasks/update_organizer_name',
+                          transactional=True)
+        return prof
 
+    def _doProfile(self, save_request=None):
+        """Get user Profile and return to user, possibly updating it first."""
         # if saveProfile(), process user-modifyable fields
         if save_request:
-            for field in ('displayName', 'teeShirtSize'):
-                if hasattr(save_request, field):
-                    val = getattr(save_request, field)
-                    if val:
-                        setattr(prof, field, str(val))
-            prof.put()
+            prof = self._saveProfile(save_request)
+            ORGANIZER_NAMES.delete(prof.key.id())
+        else:
+            # get user Profile; read-only, so the profile cache will do
+            prof = self._getProfileFromUser()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -753,53 +1258,95 @@ class ConferenceApi(remote.Service):
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    def _getNearlySoldOut(limit=None):
+        """Return conferences with 1 to 5 seats left."""
+        seat_keys = ConferenceSeats.query(ndb.AND(
+            ConferenceSeats.seatsAvailable <= 5,
+            ConferenceSeats.seatsAvailable > 0)
+        ).fetch(limit, keys_only=True)
+        confs = ndb.get_multi([key.parent() for key in seat_keys])
+        return [conf for conf in confs if conf and not conf.deleted]
+
     @staticmethod
     def _cacheAnnouncement():
         """Create Announcement & assign to memcache; used by
         memcache cron job & putAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
+        confs = ConferenceApi._getNearlySoldOut()
 
         if confs:
             # If there are almost sold out conferences,
             # format announcement and set it in memcache
             announcement = ANNOUNCEMENT_TPL % (
                 ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+            ANNOUNCEMENT_CACHE.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
         else:
             # If there are no sold out conferences,
             # delete the memcache announcements entry
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            ANNOUNCEMENT_CACHE.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
 
         return announcement
 
+    @staticmethod
+    def _primeInstanceCaches():
+        """Fill the per-instance caches; used by the warmup handler."""
+        if ANNOUNCEMENT_CACHE.get(MEMCACHE_ANNOUNCEMENTS_KEY) is None:
+            ConferenceApi._cacheAnnouncement()
+
+        # nearly sold out conferences are the ones everybody is looking at
+        hot = ConferenceApi._getNearlySoldOut(50)
+        featuredKeys = [MEMCACHE_FEATURED_TPL % conf.key.urlsafe() for conf
+                        in hot]
+        FEATURED_CACHE.get_multi(featuredKeys)
+        ConferenceApi._getOrganizerNames(
+            list(set(conf.organizerUserId for conf in hot)))
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(
-            MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement from the instance cache or memcache."""
+        announcement = ANNOUNCEMENT_CACHE.get(MEMCACHE_ANNOUNCEMENTS_KEY, "")
+        return StringMessage(data=announcement)
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser()  # get user Profile
-
         # check if conf exists given websafeConfKey
-        # get conference; check that it exists
+        # get conference; check that it exists. This read stays outside the
+        # transaction, which only touches the profile and seat inventory.
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
+        conf = resolveKey(wsck).get()
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        # a sold-out conference is turned away before the transaction, so
+        # retries never contend for its seat inventory
+        if reg and self._getSeatsAvailable([conf])[conf.key] <= 0:
+            raise ConflictException(
+                "There are no seats available; join the waitlist instead.")
+        # freed seats belong to the waitlist until the promotion task has
+        # handed them out, so retrying never jumps the queue
+        if reg and waitlist.hasWaiting(conf.key):
+            raise ConflictException(
+                "Other users are waiting for a seat; join the waitlist "
+                "instead.")
+        # profiles always store the current websafe key
+        return self._updateRegistration(conf, conf.key.urlsafe(), reg)
+
+    @txstats.transactional('registration', xg=True)
+    def _updateRegistration(self, conf, wsck, reg):
+        """Move a seat between the conference inventory and the user."""
+        retval = None
+        prof = self._getProfileFromUser()  # get user Profile
+        seats = self._seatsKey(conf.key).get()
+        if seats is None:
+            # conference created before seat inventories existed
+            seats = ConferenceSeats(key=self._seatsKey(conf.key),
+                                    seatsAvailable=conf.seatsAvailable)
 
         # register
         if reg:
@@ -809,13 +1356,13 @@ class ConferenceApi(remote.Service):
                     "You have already registered for this conference")
 
             # check if seats avail
-            if conf.seatsAvailable <= 0:
+            if seats.seatsAvailable <= 0:
                 raise ConflictException(
                     "There are no seats available.")
 
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            seats.seatsAvailable -= 1
             retval = True
 
         # unregister
@@ -823,16 +1370,18 @@ class ConferenceApi(remote.Service):
             # check if user already registered
             if wsck in prof.conferenceKeysToAttend:
 
-                # unregister user, add back one seat
+                # unregister user, add back one seat and offer it to the
+                # waitlist
                 prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                seats.seatsAvailable += 1
+                waitlist.enqueuePromotion(conf.key, transactional=True)
                 retval = True
             else:
                 retval = False
 
         # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        ndb.put_multi([prof, seats])
+        profilecache.invalidate(prof.key)
         return BooleanMessage(data=retval)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -841,24 +1390,18 @@ class ConferenceApi(remote.Service):
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser()  # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in
-                     prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        conf_keys = resolveKeys(prof.conferenceKeysToAttend)
+        conferences = [conf for conf in ndb.get_multi(conf_keys)
+                       if conf and not conf.deleted]
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in
-                      conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        # organizers' display names are stored on the conferences
+        names = self._getDisplayNames(conferences)
+        seats = self._getSeatsAvailable(conferences)
 
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(items=[self._copyConferenceToForm(conf,
-                               names[conf.organizerUserId]) for conf in
-                               conferences])
+                               names.get(conf.organizerUserId),
+                               seats[conf.key]) for conf in conferences])
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
@@ -874,6 +1417,50 @@ class ConferenceApi(remote.Service):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
+    @endpoints.method(CONF_GET_REQUEST, WaitlistForm,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='POST', name='joinWaitlist')
+    def joinWaitlist(self, request):
+        """Wait for a seat at a sold-out conference."""
+        prof = self._getProfileFromUser()  # get user Profile
+        wsck = request.websafeConferenceKey
+        conf = resolveKey(wsck).get()
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        # the promotion task registers the user into their stored Profile.
+        # get_or_insert stores the default Profile of a new user but never
+        # overwrites a stored one, and returns it fresh from the datastore
+        # rather than the possibly stale profile cache
+        prof = Profile.get_or_insert(prof.key.id(), **prof.to_dict())
+        profilecache.invalidate(prof.key)
+        if conf.key.urlsafe() in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        seatsLeft = self._getSeatsAvailable([conf])[conf.key] > 0
+        # while others wait, freed seats go through the waitlist too
+        if seatsLeft and not waitlist.hasWaiting(conf.key):
+            raise ConflictException(
+                "There are seats available; register instead.")
+        entry = waitlist.join(conf.key, prof.key.id())
+        if seatsLeft:
+            # a promotion that finished just before this join would leave
+            # the free seats and this entry behind
+            waitlist.enqueuePromotion(conf.key)
+        return WaitlistForm(websafeConferenceKey=conf.key.urlsafe(),
+                            position=waitlist.position(entry))
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='DELETE', name='leaveWaitlist')
+    def leaveWaitlist(self, request):
+        """Stop waiting for a seat at a conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        c_key = resolveKey(request.websafeConferenceKey)
+        return BooleanMessage(data=waitlist.leave(c_key, getUserId(user)))
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='filterPlayground', http_method='GET',
                       name='filterPlayground')
@@ -890,8 +1477,80 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.topics == "Medical Innovations")
         q = q.filter(Conference.month == 6)
 
+        q = [conf for conf in q if not conf.deleted]
+        seats = self._getSeatsAvailable(q)
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf, "", seats[conf.key])
+                   for conf in q]
         )
 
-api = endpoints.api_server([ConferenceApi])  # register API
+# - - - Batch - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _prefetchForBatch(self, calls):
+        """Load the entities a batch will read with one batch get.
+
+        ndb keeps every entity it gets in the per-request context cache,
+        so the sub-requests find their conference, seat inventory, stats
+        and sessions there instead of each doing its own datastore round
+        trip. The user's profile is memoized by the profile cache.
+        Malformed keys are left to fail their own sub-request.
+        """
+        websafeKeys = []
+        for name, params in calls:
+            for field in ('websafeConferenceKey', 'websafeSessionKey'):
+                if params.get(field) and isWebsafeKey(params[field]):
+                    websafeKeys.append(params[field])
+        keys = []
+        for key in resolveKeys(websafeKeys):
+            keys.append(key)
+            if key.kind() == Conference._get_kind():
+                keys.extend([self._seatsKey(key), stats.statsKey(key)])
+        ndb.get_multi(list(set(keys)))
+
+    @endpoints.method(BatchRequest, BatchResponse, path='batch',
+                      http_method='POST', name='batch')
+    def batch(self, request):
+        """Run several read-only calls and return all results at once."""
+        if len(request.requests) > BATCH_MAX_REQUESTS:
+            raise endpoints.BadRequestException(
+                'A batch holds at most %d requests' % BATCH_MAX_REQUESTS)
+        calls = []
+        for sub in request.requests:
+            try:
+                params = json.loads(sub.params or '{}')
+            except ValueError:
+                params = None
+            calls.append((sub.method, params if isinstance(params, dict)
+                          else None))
+        try:
+            self._prefetchForBatch([(name, params) for name, params in calls
+                                    if params is not None])
+        except Exception:
+            # a bad key fails its own sub-request below
+            logging.warning('batch prefetch failed', exc_info=True)
+
+        responses = []
+        for name, params in calls:
+            sub = BatchSubResponse(method=name)
+            responses.append(sub)
+            if name not in BATCH_METHODS:
+                sub.code, sub.error = 400, 'Not a batchable method: %s' % name
+                continue
+            if params is None:
+                sub.code, sub.error = 400, "'params' must be a JSON object"
+                continue
+            method = getattr(self, name)
+            try:
+                # the ProtoRPC request class, path parameters included
+                sub_request = protojson.decode_message(
+                    method.remote.request_type, json.dumps(params))
+                sub.result = protojson.encode_message(method(sub_request))
+                sub.code = 200
+            except endpoints.ServiceException as e:
+                sub.code, sub.error = e.http_status, str(e)
+            except (messages.Error, ValueError) as e:
+                sub.code, sub.error = 400, str(e)
+        return BatchResponse(responses=responses)
+
+# register API; sampled requests run under the profiler while it is on
+api = profiling.ProfilingMiddleware(endpoints.api_server([ConferenceApi]))
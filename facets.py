@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+facets.py -- Udacity conference server-side Python App Engine
+    sharded counters of conferences per city, topic, month and attendee
+    bucket, cached as a single memcache entry
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import collections
+import json
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import CounterUpdate
+from models import FacetCounterShard
+
+FACET_SHARDS = 10
+MEMCACHE_FACETS_KEY = "CONFERENCE_FACETS"
+MEMCACHE_FACETS_SECONDS = 600
+# after a write, readers that counted before it or from a query still
+# lagging it may not cache their counts for this long
+MEMCACHE_FACETS_LOCK_SECONDS = 10
+# marker shard written by a full rebuild; until it exists the counters may
+# be missing conferences created before they were introduced
+REBUILT_FACET = '__rebuilt__'
+# upper bounds of the maxAttendees buckets shown in the filter UI
+ATTENDEE_BUCKETS = [(0, '0'), (20, '1-20'), (100, '21-100'),
+                    (500, '101-500')]
+ATTENDEE_BUCKET_TOP = '500+'
+REBUILD_BATCH_SIZE = 200
+
+
+def attendeeBucket(maxAttendees):
+    """Return the name of the bucket maxAttendees falls into."""
+    for bound, name in ATTENDEE_BUCKETS:
+        if (maxAttendees or 0) <= bound:
+            return name
+    return ATTENDEE_BUCKET_TOP
+
+
+def facetValues(conf):
+    """Return the (facet, value) pairs a conference is counted under."""
+    if conf is None or conf.deleted:
+        return []
+    values = [('topic', topic) for topic in set(conf.topics or [])]
+    if conf.city:
+        values.append(('city', conf.city))
+    values.append(('month', str(conf.month or 0)))
+    values.append(('maxAttendees', attendeeBucket(conf.maxAttendees)))
+    return values
+
+
+def facetDeltas(before, after):
+    """Return the counter changes for a conference going before -> after."""
+    deltas = collections.Counter()
+    for pair in facetValues(before):
+        deltas[pair] -= 1
+    for pair in facetValues(after):
+        deltas[pair] += 1
+    return [[facet, value, delta] for (facet, value), delta in
+            deltas.items() if delta]
+
+
+def enqueueUpdate(deltas, transactional=False):
+    """Apply counter changes in the background."""
+    if deltas:
+        taskqueue.add(params={'deltas': json.dumps(deltas)},
+                      url='/tasks/update_facets',
+                      transactional=transactional)
+
+
+def _shardKey(facet, value, shard):
+    return ndb.Key(FacetCounterShard, '%s|%s|%d' % (facet, value, shard))
+
+
+@ndb.transactional_tasklet
+def _incrementShard(update_id, facet, value, delta):
+    # the task picks the shard, so a retry comes back to the shard it
+    # changed before and finds its marker there; task names are random
+    # enough to keep concurrent updates of one value apart
+    key = _shardKey(facet, value, zlib.crc32(update_id) % FACET_SHARDS)
+    marker_key = ndb.Key(CounterUpdate, update_id, parent=key)
+    shard, marker = yield ndb.get_multi_async([key, marker_key])
+    if marker is not None:
+        return
+    if shard is None:
+        shard = FacetCounterShard(key=key, facet=facet, value=value)
+    shard.count += delta
+    yield ndb.put_multi_async([shard, CounterUpdate(key=marker_key)])
+
+
+def _dropCachedFacets():
+    # locking the key keeps readers from adding counts they made before
+    # the write back into memcache
+    memcache.delete(MEMCACHE_FACETS_KEY,
+                    seconds=MEMCACHE_FACETS_LOCK_SECONDS)
+
+
+def applyDeltas(update_id, deltas):
+    """Apply [facet, value, delta] changes and drop the cached counts.
+
+    update_id names the task carrying the deltas; a retried task skips the
+    changes it already applied.
+    """
+    futures = [_incrementShard(update_id, facet, value, delta) for
+               facet, value, delta in deltas]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    _dropCachedFacets()
+
+
+def getFacets():
+    """Return {'complete': bool, 'counts': {facet: {value: count}}}."""
+    facets = memcache.get(MEMCACHE_FACETS_KEY)
+    if facets is not None:
+        return facets
+    counts = collections.defaultdict(collections.Counter)
+    for shard in FacetCounterShard.query():
+        counts[shard.facet][shard.value] += shard.count
+    complete = bool(counts.pop(REBUILT_FACET, None))
+    facets = {'complete': complete, 'counts': dict(
+        (facet, dict((value, count) for value, count in values.items()
+                     if count > 0)) for facet, values in counts.items())}
+    # add, not set: it fails while a write has the key locked
+    memcache.add(MEMCACHE_FACETS_KEY, facets, time=MEMCACHE_FACETS_SECONDS)
+    return facets
+
+
+def rebuild():
+    """Recount every conference and replace all counter shards."""
+    counts = collections.Counter()
+    cursor, more = None, True
+    while more:
+        confs, cursor, more = Conference.query().fetch_page(
+            REBUILD_BATCH_SIZE, start_cursor=cursor)
+        for conf in confs:
+            counts.update(facetValues(conf))
+    ndb.delete_multi(FacetCounterShard.query().fetch(keys_only=True))
+    shards = [FacetCounterShard(key=_shardKey(facet, value, 0), facet=facet,
+                                value=value, count=count)
+              for (facet, value), count in counts.items()]
+    shards.append(FacetCounterShard(key=_shardKey(REBUILT_FACET, '', 0),
+                                    facet=REBUILT_FACET, value='', count=1))
+    ndb.put_multi(shards)
+    _dropCachedFacets()
@@ -12,36 +12,78 @@ created by wesc on 2014 may 24
 
 __authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
 
+import collections
+import json
+from datetime import datetime
+from datetime import timedelta
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from conference import ConferenceApi
-from models import Speaker
+import catalog
+import facets
+import profiling
+import purge
+import recommend
+import rekey
+import speakercounts
+import stats
+import txstats
+import waitlist
+from caches import FEATURED_CACHE
+from caches import cacheStats
+from models import Conference
+from models import ConferenceSeats
+from models import CounterUpdate
+from models import Profile
+from models import ProfileReport
 from models import Session
+from outbox import drainOutbox
+from outbox import enqueueConfirmation
+from utils import activeMonths
+from utils import sessionTimeFields
+
+BACKFILL_BATCH_SIZE = 100
+REKEY_BATCH_SIZE = 10
+# one cross-group transaction may touch at most 25 entity groups
+XG_BATCH_SIZE = 25
+# a counter task still failing after this long can apply its change twice
+# once its markers are swept; the rebuilds and repairs put that right
+COUNTER_UPDATE_DAYS = 7
+SWEEP_BATCH_SIZE = 500
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Import the API and fill per-instance caches before traffic."""
+        from conference import ConferenceApi
+        ConferenceApi._primeInstanceCaches()
+        self.response.set_status(200)
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
+        # imported here so task handlers don't pay for the whole API
+        from conference import ConferenceApi
         ConferenceApi._cacheAnnouncement()
         self.response.set_status(204)
 
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
+        """Move a queued confirmation task into the mail outbox."""
+        enqueueConfirmation(self.request.get('email'),
+                            self.request.get('conferenceInfo'))
+
+
+class DrainMailOutboxHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send a rate-limited batch of emails from the mail outbox."""
+        drainOutbox()
+        self.response.set_status(204)
 
 
 class ReviewSpeakersForSessions(webapp2.RequestHandler):
@@ -49,50 +91,465 @@ class ReviewSpeakersForSessions(webapp2.RequestHandler):
         """Will review for additional sessions by speakers."""
         # turns urlsafe key string into conference key
         c_key = ndb.Key(urlsafe=self.request.get('c_key_str'))
-        # all sessions are obtained from conference
-        conference_Sessions = Session.query(ancestor=c_key)
-        # all speakers are obtained
-        speakers = Speaker.query()
-        # speakers sorted by their names
-        speakers = speakers.order(Speaker.name)
-        # featured speakers as empty list
-        ftrdSpkrKeys = []
-        # review each speaker
-        for spkr in speakers:
-            count = 0
-            # counts number of sessions speaker holds in conference
-            for session in conference_Sessions:
-                for cs_speaker_key in session.speakers:
-                    if spkr.key == cs_speaker_key:
-                        count += 1
-                        # feature speaker if in greater than one session
-                        if count == 2:
-                            # the featured speakers list gets speaker key
-                            # appended
-                            ftrdSpkrKeys.append(cs_speaker_key)
+        # all sessions are obtained from conference, with one query
+        conference_Sessions = Session.query(ancestor=c_key).fetch()
+        # counts number of sessions each speaker holds in conference
+        counts = collections.Counter(
+            spkr_key for session in conference_Sessions
+            for spkr_key in session.speakers)
+        # feature speaker if in greater than one session; the featured
+        # speakers are read in one batch and sorted by their names
+        ftrdSpkrs = sorted(
+            (spkr for spkr in ndb.get_multi(
+                [key for key, count in counts.items() if count >= 2])
+             if spkr), key=lambda spkr: spkr.name)
         # The urlsafe key for conference is set as memcache key.
         MEMCACHE_CONFERENCE_KEY = "FEATURED:%s" % c_key.urlsafe()
         # Set in memcache and arrange the featured speakers announcement when
         # there are featured speakers at conference.
-        if ftrdSpkrKeys:
+        if ftrdSpkrs:
             count = 0
             featured = "FEATURED SPEAKERS AND SESSIONS FOR THE CONFERENCE:  "
-            for speaker_key in ftrdSpkrKeys:
+            for spkr in ftrdSpkrs:
                 count += 1
                 featured += " FEATURED %s: %s SESSIONS: " % (
-                    count, speaker_key.get().name)
-                sessionsFtrdSpkrs = conference_Sessions.filter(
-                    Session.speakers == speaker_key)
-                featured += ", ".join(sess.name for sess in sessionsFtrdSpkrs)
-            memcache.set(MEMCACHE_CONFERENCE_KEY, featured)
+                    count, spkr.name)
+                featured += ", ".join(sess.name for sess in
+                                      conference_Sessions
+                                      if spkr.key in sess.speakers)
+            # every replica of the hot key is written
+            FEATURED_CACHE.set(MEMCACHE_CONFERENCE_KEY, featured)
         else:
             # If there are no featured speakers at conference,
             # delete the memcache announcements entry.
             featured = ""
-            memcache.delete(MEMCACHE_CONFERENCE_KEY)
+            FEATURED_CACHE.delete(MEMCACHE_CONFERENCE_KEY)
+
+class BackfillSessionTimes(webapp2.RequestHandler):
+    def get(self):
+        """Start backfilling the integer time fields on all sessions."""
+        taskqueue.add(url='/tasks/backfill_session_times')
+        self.response.set_status(202)
+
+    def post(self):
+        """Backfill one batch of sessions, then enqueue the next batch."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        sessions, next_cursor, more = Session.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        for sess in sessions:
+            fields = sessionTimeFields(sess.date, sess.startTime,
+                                       sess.duration)
+            for name, value in fields.items():
+                setattr(sess, name, value)
+        ndb.put_multi(sessions)
+        # chain the next batch so each task stays well within its deadline
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/backfill_session_times')
+
+
+@ndb.transactional
+def _createSeatsIfMissing(key, seatsAvailable):
+    """Create a seat inventory unless a registration already did."""
+    if key.get() is None:
+        ConferenceSeats(key=key, seatsAvailable=seatsAvailable).put()
+
+
+class BackfillConferenceSeats(webapp2.RequestHandler):
+    def get(self):
+        """Start creating seat inventories for older conferences."""
+        taskqueue.add(url='/tasks/backfill_conference_seats')
+        self.response.set_status(202)
+
+    def post(self):
+        """Create missing seat inventories for one batch of conferences."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        c_keys, next_cursor, more = Conference.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        seat_keys = [ndb.Key(ConferenceSeats, 1, parent=c_key) for c_key in
+                     c_keys]
+        missing = [key for key, seats in zip(seat_keys,
+                   ndb.get_multi(seat_keys)) if seats is None]
+        confs = ndb.get_multi([key.parent() for key in missing])
+        for key, conf in zip(missing, confs):
+            _createSeatsIfMissing(key, conf.seatsAvailable)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/backfill_conference_seats')
+
+
+@ndb.transactional(xg=True)
+def _setActiveMonths(c_keys):
+    """Store activeMonths on conferences, re-read in a transaction."""
+    changed = []
+    for conf in ndb.get_multi(c_keys):
+        if conf is None:
+            continue
+        months = activeMonths(conf.startDate, conf.endDate)
+        if conf.activeMonths != months:
+            conf.activeMonths = months
+            changed.append(conf)
+    ndb.put_multi(changed)
+
+
+class BackfillConferenceMonths(webapp2.RequestHandler):
+    def get(self):
+        """Start storing the calendar months on older conferences."""
+        taskqueue.add(url='/tasks/backfill_conference_months')
+        self.response.set_status(202)
+
+    def post(self):
+        """Store the calendar months on one batch of conferences."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        confs, next_cursor, more = Conference.query().fetch_page(
+            XG_BATCH_SIZE, start_cursor=cursor)
+        missing = [conf.key for conf in confs if conf.startDate and
+                   not conf.activeMonths]
+        if missing:
+            _setActiveMonths(missing)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/backfill_conference_months')
+
+
+class RekeyConferences(webapp2.RequestHandler):
+    def get(self):
+        """Start moving conferences out of their organizers' groups."""
+        if not rekey.CONFERENCE_KEY_LAYOUT == rekey.ROOT_LAYOUT:
+            self.response.set_status(409)
+            self.response.write("Set CONFERENCE_KEY_LAYOUT = 'root' first.")
+            return
+        taskqueue.add(url='/tasks/rekey_conferences')
+        self.response.set_status(202)
+
+    def post(self):
+        """Move one batch of conferences to root keys."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        c_keys, next_cursor, more = Conference.query().fetch_page(
+            REKEY_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for c_key in c_keys:
+            # conferences already at the root are left alone
+            if c_key.parent() is not None:
+                new_key = rekey.moveConference(c_key)
+                FEATURED_CACHE.delete("FEATURED:%s" % c_key.urlsafe())
+                taskqueue.add(params={'c_key_str': new_key.urlsafe()},
+                              url='/tasks/review_speakers_for_sessions')
+        # the catalog links conferences by their old keys until rebuilt
+        catalog.checkRebuildRpc(catalog.enqueueRebuildAsync())
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/rekey_conferences')
+
+
+@ndb.transactional(xg=True)
+def _setOrganizerNames(c_keys, names):
+    """Copy organizer names onto conferences, re-read in a transaction."""
+    changed = []
+    for conf in ndb.get_multi(c_keys):
+        name = names.get(conf.organizerUserId) if conf else None
+        if name is not None and conf.organizerDisplayName != name:
+            conf.organizerDisplayName = name
+            changed.append(conf)
+    ndb.put_multi(changed)
+
+
+class UpdateOrganizerName(webapp2.RequestHandler):
+    def post(self):
+        """Copy an organizer's displayName onto a batch of conferences."""
+        user_id = self.request.get('user_id')
+        prof = ndb.Key(Profile, user_id).get()
+        if prof is None:
+            return
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        c_keys, next_cursor, more = Conference.query(
+            Conference.organizerUserId == user_id).fetch_page(
+            XG_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        _setOrganizerNames(c_keys, {user_id: prof.displayName})
+        catalog.checkRebuildRpc(catalog.enqueueRebuildAsync())
+        if more and next_cursor:
+            taskqueue.add(params={'user_id': user_id,
+                                  'cursor': next_cursor.urlsafe()},
+                          url='/tasks/update_organizer_name')
+
+
+class BackfillOrganizerNames(webapp2.RequestHandler):
+    def get(self):
+        """Start storing organizer names on older conferences."""
+        taskqueue.add(url='/tasks/backfill_organizer_names')
+        self.response.set_status(202)
+
+    def post(self):
+        """Store organizer names on one batch of conferences."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        confs, next_cursor, more = Conference.query().fetch_page(
+            XG_BATCH_SIZE, start_cursor=cursor)
+        missing = [conf for conf in confs if conf.organizerDisplayName is None]
+        user_ids = list(set(conf.organizerUserId for conf in missing))
+        names = dict((prof.key.id(), prof.displayName) for prof in
+                     ndb.get_multi([ndb.Key(Profile, user_id) for user_id in
+                                    user_ids]) if prof)
+        if missing:
+            _setOrganizerNames([conf.key for conf in missing], names)
+            catalog.checkRebuildRpc(catalog.enqueueRebuildAsync())
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/backfill_organizer_names')
+
+
+class UpdateConferenceStats(webapp2.RequestHandler):
+    def post(self):
+        """Recompute the session statistics of one conference."""
+        stats.recompute(ndb.Key(urlsafe=self.request.get('c_key_str')))
+
+
+class RepairConferenceStats(webapp2.RequestHandler):
+    def get(self):
+        """Start recomputing the session statistics of every conference."""
+        taskqueue.add(url='/tasks/repair_conference_stats')
+        self.response.set_status(202)
+
+    def post(self):
+        """Recompute the session statistics of one batch of conferences."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        next_cursor = stats.repairBatch(cursor)
+        if next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/repair_conference_stats')
+
+
+class UpdateSpeakerCounts(webapp2.RequestHandler):
+    def post(self):
+        """Apply session changes to the speaker counters."""
+        # a retried task keeps its name
+        speakercounts.applyDeltas(
+            self.request.headers['X-AppEngine-TaskName'],
+            json.loads(self.request.get('deltas')))
+
+
+class RepairSpeakerCounts(webapp2.RequestHandler):
+    def get(self):
+        """Start recounting every speaker from their sessions."""
+        taskqueue.add(url='/tasks/repair_speaker_counts')
+        self.response.set_status(202)
+
+    def post(self):
+        """Recount one batch of speakers from their sessions."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        next_cursor = speakercounts.repairBatch(cursor)
+        if next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/repair_speaker_counts')
+
+
+class PromoteWaitlist(webapp2.RequestHandler):
+    def post(self):
+        """Give free seats to the next batch of waitlisted users."""
+        c_key = ndb.Key(urlsafe=self.request.get('c_key_str'))
+        if waitlist.promoteBatch(c_key):
+            waitlist.enqueuePromotion(c_key)
+
+
+class PurgeConference(webapp2.RequestHandler):
+    def post(self):
+        """Purge one batch of a deleted conference, then chain the next."""
+        c_key = ndb.Key(urlsafe=self.request.get('c_key_str'))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        step = purge.purgeStep(
+            c_key, self.request.get('stage') or purge.STAGE_SESSIONS, cursor)
+        if step:
+            stage, next_cursor = step
+            purge.enqueuePurge(c_key, stage, next_cursor)
+
+
+class SweepDeletedConferences(webapp2.RequestHandler):
+    def get(self):
+        """Restart purges of deleted conferences that were interrupted."""
+        purge.sweepDeleted()
+        self.response.set_status(204)
+
+
+class PruneWishlists(webapp2.RequestHandler):
+    def post(self):
+        """Remove a deleted session from one batch of wishlists."""
+        wssk = self.request.get('s_key_str')
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        next_cursor = purge.pruneProfiles('wishlistSessionsKeys', [wssk],
+                                          cursor)
+        if next_cursor:
+            taskqueue.add(params={'s_key_str': wssk,
+                                  'cursor': next_cursor.urlsafe()},
+                          url='/tasks/prune_wishlists')
+
+
+class BuildRecommendations(webapp2.RequestHandler):
+    def get(self):
+        """Start recomputing session recommendations from wishlists."""
+        taskqueue.add(url='/tasks/build_recommendations')
+        self.response.set_status(202)
+
+    def post(self):
+        """Recompute one conference's recommendations, or enqueue that for
+        one batch of conferences."""
+        if self.request.get('c_key_str'):
+            recommend.buildRecommendations(
+                ndb.Key(urlsafe=self.request.get('c_key_str')))
+            return
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        next_cursor = recommend.enqueueBuilds(cursor)
+        if next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/build_recommendations')
+
+
+class BuildCatalog(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the catalog snapshot, picking up seat changes."""
+        catalog.buildSnapshot()
+        self.response.set_status(204)
+
+    def post(self):
+        """Rebuild the catalog snapshot after conference writes."""
+        catalog.buildSnapshot()
+
+
+class CatalogPointerHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the version and page count of the current catalog."""
+        pointer = catalog.getPointer()
+        if pointer is None:
+            # not built yet; the listing falls back to queryConferences
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Cache-Control'] = (
+            'public, max-age=%d' % catalog.POINTER_MAX_AGE)
+        self.response.write(json.dumps(pointer))
+
+
+class CatalogChunkHandler(webapp2.RequestHandler):
+    def get(self, version, page):
+        """Return one page of a catalog version, gzipped when accepted."""
+        data = catalog.getChunk(version, int(page))
+        if data is None:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        # a version's pages never change, so any cache may keep them
+        self.response.headers['Cache-Control'] = (
+            'public, max-age=%d' % catalog.CHUNK_MAX_AGE)
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.response.headers['Content-Encoding'] = 'gzip'
+        else:
+            data = catalog.gunzip(data)
+        self.response.write(data)
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report hit rates and memcache QPS of the hot-key caches."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            cacheStats(reset=bool(self.request.get('reset'))), indent=2))
+
+
+class TxStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report transaction retries, collisions and hot entity groups."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(txstats.report(), indent=2))
+
+
+class ProfilingHandler(webapp2.RequestHandler):
+    def get(self):
+        """List recent profile reports, or show one with ?id=."""
+        self.response.headers['Content-Type'] = 'application/json'
+        if self.request.get('id'):
+            report = ProfileReport.get_by_id(int(self.request.get('id')))
+            if report is None:
+                self.abort(404)
+            result = dict(report.report, path=report.path,
+                          totalMs=report.totalMs)
+        else:
+            reports = ProfileReport.query().order(
+                -ProfileReport.created).fetch(50)
+            result = {'config': profiling.getConfig(), 'reports': [
+                {'id': report.key.id(), 'path': report.path,
+                 'created': str(report.created), 'totalMs': report.totalMs}
+                for report in reports]}
+        self.response.write(json.dumps(result, indent=2))
+
+    def post(self):
+        """Turn profiling on for ?minutes= at ?sampleRate=, or ?off=1."""
+        if self.request.get('off'):
+            profiling.disable()
+        else:
+            profiling.setConfig(
+                float(self.request.get('sampleRate') or 0.01),
+                int(self.request.get('minutes') or 15))
+        self.redirect('/admin/profiling')
+
+
+class UpdateFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply conference facet counter changes."""
+        # a retried task keeps its name
+        facets.applyDeltas(self.request.headers['X-AppEngine-TaskName'],
+                           json.loads(self.request.get('deltas')))
+
+
+class RebuildFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start recounting the conference facets from scratch."""
+        taskqueue.add(url='/tasks/rebuild_facets')
+        self.response.set_status(202)
+
+    def post(self):
+        """Recount the conference facets from scratch."""
+        facets.rebuild()
+
+
+class SweepCounterUpdates(webapp2.RequestHandler):
+    def get(self):
+        """Delete counter task markers too old for their task to retry."""
+        cutoff = datetime.now() - timedelta(days=COUNTER_UPDATE_DAYS)
+        keys = CounterUpdate.query(CounterUpdate.created < cutoff).fetch(
+            SWEEP_BATCH_SIZE, keys_only=True)
+        ndb.delete_multi(keys)
+        if len(keys) == SWEEP_BATCH_SIZE:
+            taskqueue.add(url='/crons/sweep_counter_updates', method='GET')
+        self.response.set_status(204)
+
 
-app = webapp2.WSGIApplication([
+app = profiling.ProfilingMiddleware(webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/review_speakers_for_sessions', ReviewSpeakersForSessions)
-], debug=True)
+    ('/crons/drain_mail_outbox', DrainMailOutboxHandler),
+    ('/tasks/review_speakers_for_sessions', ReviewSpeakersForSessions),
+    ('/tasks/backfill_session_times', BackfillSessionTimes),
+    ('/tasks/backfill_conference_seats', BackfillConferenceSeats),
+    ('/tasks/backfill_conference_months', BackfillConferenceMonths),
+    ('/tasks/rekey_conferences', RekeyConferences),
+    ('/tasks/update_organizer_name', UpdateOrganizerName),
+    ('/tasks/backfill_organizer_names', BackfillOrganizerNames),
+    ('/tasks/update_conference_stats', UpdateConferenceStats),
+    ('/tasks/repair_conference_stats', RepairConferenceStats),
+    ('/tasks/update_speaker_counts', UpdateSpeakerCounts),
+    ('/tasks/repair_speaker_counts', RepairSpeakerCounts),
+    ('/crons/repair_speaker_counts', RepairSpeakerCounts),
+    ('/tasks/promote_waitlist', PromoteWaitlist),
+    ('/tasks/purge_conference', PurgeConference),
+    ('/crons/sweep_deleted_conferences', SweepDeletedConferences),
+    ('/tasks/prune_wishlists', PruneWishlists),
+    ('/crons/build_recommendations', BuildRecommendations),
+    ('/tasks/build_recommendations', BuildRecommendations),
+    ('/crons/build_catalog', BuildCatalog),
+    ('/tasks/build_catalog', BuildCatalog),
+    ('/catalog/current.json', CatalogPointerHandler),
+    (r'/catalog/([0-9a-f]+)/(\d+)\.json', CatalogChunkHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/txstats', TxStatsHandler),
+    ('/admin/profiling', ProfilingHandler),
+    ('/tasks/update_facets', UpdateFacetsHandler),
+    ('/tasks/rebuild_facets', RebuildFacetsHandler),
+    ('/crons/sweep_counter_updates', SweepCounterUpdates)
+], debug=True))
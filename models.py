@@ -19,6 +19,11 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- exception mapped to HTTP 429 response"""
+    http_status = 429
+
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
@@ -58,13 +63,49 @@ class Conference(ndb.Model):
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    # copy of the organizer's Profile.displayName, kept current by a task
+    organizerDisplayName = ndb.StringProperty(indexed=False)
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
     month           = ndb.IntegerProperty()
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
-    seatsAvailable  = ndb.IntegerProperty()
+    # seats at creation; the live count is kept in ConferenceSeats
+    seatsAvailable  = ndb.IntegerProperty(indexed=False)
+    # set by deleteConference; the entities go once the purge task runs
+    deleted         = ndb.BooleanProperty(default=False)
+    # YYYYMM of every month from startDate to endDate, for the calendar
+    activeMonths    = ndb.IntegerProperty(repeated=True)
+
+
+class ConferenceSeats(ndb.Model):
+    """ConferenceSeats -- seat inventory, a child of its Conference"""
+    seatsAvailable = ndb.IntegerProperty()
+
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- a user waiting for a seat, keyed by
+    '<websafe conference key>|<user id>' outside the conference's group"""
+    conference = ndb.KeyProperty(kind='Conference')
+    userId = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class WaitlistForm(messages.Message):
+    """WaitlistForm -- a user's place on a conference waitlist"""
+    websafeConferenceKey = messages.StringField(1)
+    position = messages.IntegerField(2)
+
+
+class ConferenceStats(ndb.Model):
+    """ConferenceStats -- session statistics, a child of its Conference"""
+    sessionCount = ndb.IntegerProperty(default=0, indexed=False)
+    # {typeOfSession: count} and {'YYYY-MM-DD': count}
+    sessionsByType = ndb.JsonProperty()
+    sessionsByDay = ndb.JsonProperty()
+    speakerCount = ndb.IntegerProperty(default=0, indexed=False)
+    totalMinutes = ndb.IntegerProperty(default=0, indexed=False)
 
 
 class ConferenceForm(messages.Message):
@@ -88,6 +129,82 @@ class ConferenceForms(messages.Message):
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
 
 
+class KeyRedirect(ndb.Model):
+    """KeyRedirect -- maps an old websafe key (the ID) to its new key"""
+    newKey = ndb.KeyProperty(indexed=False)
+
+
+class ProfileReport(ndb.Model):
+    """ProfileReport -- profile of one sampled request"""
+    path = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    totalMs = ndb.IntegerProperty(indexed=False)
+    # {'status', 'functions': [[function, calls, ownMs, cumulativeMs]],
+    #  'rpcs': [[service.call, startMs, durationMs, error]]}
+    report = ndb.JsonProperty(compressed=True)
+
+
+class FacetCounterShard(ndb.Model):
+    """FacetCounterShard -- one shard of a conference facet counter"""
+    facet = ndb.StringProperty()
+    value = ndb.StringProperty()
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class CounterUpdate(ndb.Model):
+    """CounterUpdate -- marks one counter task as applied to the counter
+    shard it is a child of, keyed by the task name"""
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class CatalogChunk(ndb.Model):
+    """CatalogChunk -- one page of a public catalog snapshot, keyed by
+    '<version>-<page>'"""
+    version = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    # gzipped JSON {'items': [ConferenceForm JSON]}, served as it is
+    data = ndb.BlobProperty()
+
+
+class CatalogVersion(ndb.Model):
+    """CatalogVersion -- pointer to the catalog snapshot being served"""
+    version = ndb.StringProperty(indexed=False)
+    previous = ndb.StringProperty(indexed=False)
+    chunks = ndb.IntegerProperty(indexed=False)
+    count = ndb.IntegerProperty(indexed=False)
+    built = ndb.DateTimeProperty(auto_now=True)
+
+
+class FacetCountForm(messages.Message):
+    """FacetCountForm -- number of conferences having a facet value"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class ConferenceFacetsForm(messages.Message):
+    """ConferenceFacetsForm -- facet counts for the conference filters"""
+    city = messages.MessageField(FacetCountForm, 1, repeated=True)
+    topic = messages.MessageField(FacetCountForm, 2, repeated=True)
+    month = messages.MessageField(FacetCountForm, 3, repeated=True)
+    maxAttendees = messages.MessageField(FacetCountForm, 4, repeated=True)
+
+
+class SessionCountForm(messages.Message):
+    """SessionCountForm -- number of sessions having a value"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class ConferenceStatsForm(messages.Message):
+    """ConferenceStatsForm -- session statistics outbound form message"""
+    sessionCount = messages.IntegerField(1)
+    sessionsByType = messages.MessageField(SessionCountForm, 2, repeated=True)
+    sessionsByDay = messages.MessageField(SessionCountForm, 3, repeated=True)
+    speakerCount = messages.IntegerField(4)
+    totalMinutes = messages.IntegerField(5)
+    websafeConferenceKey = messages.StringField(6)
+
+
 class Speaker(ndb.Model):
     """Speaker -- Speaker can present for multiple conferences."""
     name = ndb.StringProperty(required=True)
@@ -98,6 +215,29 @@ class SpeakerForm(messages.Message):
     name = messages.StringField(1, required=True)
 
 
+class SpeakerCounterShard(ndb.Model):
+    """SpeakerCounterShard -- one shard of a speaker's counters across all
+    conferences, keyed by '<speaker id>|<shard>'"""
+    speaker = ndb.KeyProperty(kind=Speaker, indexed=False)
+    sessions = ndb.IntegerProperty(default=0, indexed=False)
+    conferences = ndb.IntegerProperty(default=0, indexed=False)
+    upcoming = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class TopSpeakerForm(messages.Message):
+    """TopSpeakerForm -- one speaker of the speaker leaderboard"""
+    name = messages.StringField(1)
+    sessions = messages.IntegerField(2)
+    conferences = messages.IntegerField(3)
+    upcomingSessions = messages.IntegerField(4)
+
+
+class TopSpeakersForm(messages.Message):
+    """TopSpeakersForm -- one page of the speaker leaderboard"""
+    items = messages.MessageField(TopSpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
 class Session(ndb.Model):
     """Session -- Session object"""
     name = ndb.StringProperty(required=True)
@@ -111,6 +251,12 @@ class Session(ndb.Model):
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
     location = ndb.StringProperty()
+    # integer encodings of the schedule, used for indexed range queries:
+    # minutes since midnight for start and end, and the start as minutes
+    # since 0001-01-01 so date and time sort together
+    startMinutes = ndb.IntegerProperty()
+    endMinutes = ndb.IntegerProperty()
+    startOrdinal = ndb.IntegerProperty()
 
 
 class SessionForm(messages.Message):
@@ -128,11 +274,44 @@ class SessionForm(messages.Message):
     websafeConfKey = messages.StringField(10)
 
 
+class SessionRecommendations(ndb.Model):
+    """SessionRecommendations -- wishlist neighbours of the sessions of a
+    conference, a child of its Conference"""
+    # {session id: [[neighbour session id, wishlists holding both], ...]}
+    neighbours = ndb.JsonProperty(compressed=True)
+
+
 class SessionForms(messages.Message):
     """SessionForms -- messages for multiple Session forms"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
 
 
+class BatchSubRequest(messages.Message):
+    """BatchSubRequest -- one ConferenceApi call inside a batch"""
+    method = messages.StringField(1, required=True)
+    # JSON object of the method's path, query and body fields
+    params = messages.StringField(2)
+
+
+class BatchRequest(messages.Message):
+    """BatchRequest -- ConferenceApi calls answered in one round trip"""
+    requests = messages.MessageField(BatchSubRequest, 1, repeated=True)
+
+
+class BatchSubResponse(messages.Message):
+    """BatchSubResponse -- outcome of one call inside a batch"""
+    method = messages.StringField(1)
+    code = messages.IntegerField(2)
+    # JSON of the method's response message, or the error message
+    result = messages.StringField(3)
+    error = messages.StringField(4)
+
+
+class BatchResponse(messages.Message):
+    """BatchResponse -- outcomes of a batch, in request order"""
+    responses = messages.MessageField(BatchSubResponse, 1, repeated=True)
+
+
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
     NOT_SPECIFIED = 1
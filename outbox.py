@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+outbox.py -- Udacity conference server-side Python App Engine mail outbox;
+    notices are parked on a pull queue and sent in rate-limited batches
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import json
+import logging
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.runtime import apiproxy_errors
+
+from settings import MAIL_LEASE_BATCH_SIZE
+from settings import MAIL_MAX_ATTEMPTS
+from settings import MAIL_SENDS_PER_RUN
+
+OUTBOX_QUEUE = 'mail-outbox'
+LEASE_SECONDS = 60
+CONFIRMATION_SUBJECT = 'You created a new Conference!'
+CONFIRMATION_SUBJECT_MANY = 'You created %d new Conferences!'
+CONFIRMATION_BODY = 'Hi, you have created the following conference%s:'
+
+
+def formatConference(conf):
+    """Return a short plain text summary of a ConferenceForm."""
+    lines = [conf.name]
+    if conf.city:
+        lines.append('City: %s' % conf.city)
+    if conf.startDate:
+        lines.append('Dates: %s - %s' % (conf.startDate, conf.endDate or ''))
+    if conf.topics:
+        lines.append('Topics: %s' % ', '.join(conf.topics))
+    if conf.maxAttendees:
+        lines.append('Max attendees: %s' % conf.maxAttendees)
+    return '\r\n'.join(lines)
+
+
+def enqueueConfirmation(email, conferenceInfo):
+    """Park a creation notice for an organizer on the outbox queue."""
+    # the tag lets the worker lease all notices of one organizer together
+    task = taskqueue.Task(payload=json.dumps({'info': conferenceInfo}),
+                          method='PULL', tag=email)
+    taskqueue.Queue(OUTBOX_QUEUE).add(task)
+
+
+def _sendCoalesced(email, infos):
+    """Send one email to the organizer covering every queued notice."""
+    if len(infos) == 1:
+        subject = CONFIRMATION_SUBJECT
+    else:
+        subject = CONFIRMATION_SUBJECT_MANY % len(infos)
+    body = CONFIRMATION_BODY % ('s' if len(infos) > 1 else '')
+    body += '\r\n\r\n' + '\r\n\r\n'.join(infos)
+    mail.send_mail(
+        'noreply@%s.appspotmail.com' % (
+            app_identity.get_application_id()),     # from
+        email,                                      # to
+        subject,                                    # subj
+        body                                        # body
+    )
+
+
+def drainOutbox(maxSends=MAIL_SENDS_PER_RUN):
+    """Send up to maxSends emails from the outbox; return (sent, notices)."""
+    queue = taskqueue.Queue(OUTBOX_QUEUE)
+    sent = notices = 0
+    while sent < maxSends:
+        # leases the oldest tasks sharing a tag, i.e. one organizer
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, MAIL_LEASE_BATCH_SIZE)
+        if not tasks:
+            break
+        infos = [json.loads(task.payload)['info'] for task in tasks]
+        # a failed send still uses up one of this run's sends
+        sent += 1
+        try:
+            _sendCoalesced(tasks[0].tag, infos)
+        except (mail.Error, apiproxy_errors.Error) as e:
+            # an expired lease puts the notices back in line, until they
+            # have been tried MAIL_MAX_ATTEMPTS times
+            dead = [task for task in tasks if
+                    task.retry_count >= MAIL_MAX_ATTEMPTS]
+            if dead:
+                logging.error('Giving up on %d notices to %s: %s',
+                              len(dead), tasks[0].tag, e)
+                queue.delete_tasks(dead)
+            continue
+        # only delete once sent
+        queue.delete_tasks(tasks)
+        notices += len(tasks)
+    return sent, notices
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+profilecache.py -- Udacity conference server-side Python App Engine
+    user Profile reads served from a per-request memo and a short-lived
+    instance cache, dropped by every path that writes a Profile
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import copy
+import os
+import threading
+
+from google.appengine.ext import ndb
+
+from caches import PROFILES
+from models import Profile
+
+# os.environ starts empty for every request, so a marker in it tells a
+# new request from the last one handled on this thread (ndb finds its
+# per-request context the same way)
+_REQUEST_MARKER = 'CONFERENCE_PROFILE_MEMO'
+_local = threading.local()
+_MISSING = object()
+
+
+def _requestMemo():
+    if not os.environ.get(_REQUEST_MARKER) or not hasattr(_local, 'memo'):
+        os.environ[_REQUEST_MARKER] = '1'
+        _local.memo = {}
+    return _local.memo
+
+
+def getProfile(p_key):
+    """Return the stored Profile of p_key, or None if there is none.
+
+    Within a request every call returns the same object, like the ndb
+    context cache. Inside a transaction the Profile is always read from
+    the datastore, so a write never starts from a cached copy; every path
+    that puts a Profile must read it in the transaction that puts it.
+    """
+    if ndb.in_transaction():
+        return p_key.get()
+    memo = _requestMemo()
+    user_id = p_key.id()
+    if user_id in memo:
+        return memo[user_id]
+    values = PROFILES.get(user_id, _MISSING)
+    if values is _MISSING:
+        prof = p_key.get()
+        values = prof.to_dict() if prof else None
+        # the cache keeps its own copy; callers may change their entity
+        PROFILES.set(user_id, copy.deepcopy(values))
+    else:
+        prof = None
+        if values is not None:
+            prof = Profile(key=p_key, **copy.deepcopy(values))
+    memo[user_id] = prof
+    return prof
+
+
+def invalidate(p_key):
+    """Drop the cached copies of a Profile that is being written.
+
+    Call it next to every put of a Profile; in a transaction the copies
+    are dropped again once it commits.
+    """
+    user_id = p_key.id()
+
+    def drop():
+        PROFILES.delete(user_id)
+        _requestMemo().pop(user_id, None)
+    drop()
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(drop)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+profiling.py -- Udacity conference server-side Python App Engine
+    on-demand profiler for API and task requests; an admin turns it on
+    for a while, and sampled requests (or requests carrying the debug
+    header) are run under cProfile with a timeline of their service RPCs
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import cProfile
+import logging
+import pstats
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from caches import LocalCache
+from models import ProfileReport
+
+MEMCACHE_PROFILING_KEY = "PROFILING_CONFIG"
+# requests carrying this header are profiled while profiling is on
+PROFILE_HEADER = 'HTTP_X_CONFERENCE_PROFILE'
+# instances re-read the switch this often, so a disabled profiler costs
+# one local lookup per request
+CONFIG_TTL = 10
+TOP_FUNCTIONS = 30
+MAX_RPCS = 200
+REPORTS_KEPT = 200
+
+_CONFIG = LocalCache(ttl=CONFIG_TTL)
+_local = threading.local()
+_hooksInstalled = []
+_hooksLock = threading.Lock()
+
+
+def getConfig():
+    """Return the profiling switch, or None while profiling is off."""
+    config = _CONFIG.get(MEMCACHE_PROFILING_KEY, False)
+    if config is False:
+        config = memcache.get(MEMCACHE_PROFILING_KEY)
+        _CONFIG.set(MEMCACHE_PROFILING_KEY, config)
+    if config and config['until'] < time.time():
+        return None
+    return config
+
+
+def setConfig(sampleRate, minutes):
+    """Profile sampleRate of all requests for the next minutes."""
+    config = {'sampleRate': sampleRate, 'until': time.time() + minutes * 60}
+    memcache.set(MEMCACHE_PROFILING_KEY, config, time=minutes * 60)
+    _CONFIG.set(MEMCACHE_PROFILING_KEY, config)
+    # keep only the newest reports
+    old = ProfileReport.query().order(-ProfileReport.created).fetch(
+        offset=REPORTS_KEPT, keys_only=True)
+    ndb.delete_multi(old)
+    return config
+
+
+def disable():
+    memcache.delete(MEMCACHE_PROFILING_KEY)
+    _CONFIG.set(MEMCACHE_PROFILING_KEY, None)
+
+
+def _preCall(service, call, request, response, rpc):
+    recorder = getattr(_local, 'rpcs', None)
+    if recorder is not None:
+        recorder['started'][id(rpc)] = time.time()
+
+
+def _postCall(service, call, request, response, rpc, error):
+    recorder = getattr(_local, 'rpcs', None)
+    if recorder is None:
+        return
+    started = recorder['started'].pop(id(rpc), None)
+    if started is None or len(recorder['timeline']) >= MAX_RPCS:
+        return
+    now = time.time()
+    recorder['timeline'].append([
+        '%s.%s' % (service, call),
+        int((started - recorder['origin']) * 1000),
+        int((now - started) * 1000),
+        type(error).__name__ if error else None])
+
+
+def _installHooks():
+    # the hooks are process wide; requests that are not being profiled
+    # leave them at the first attribute lookup
+    with _hooksLock:
+        if not _hooksInstalled:
+            apiproxy = apiproxy_stub_map.apiproxy
+            apiproxy.GetPreCallHooks().Append('profiling', _preCall)
+            apiproxy.GetPostCallHooks().Append('profiling', _postCall)
+            _hooksInstalled.append(True)
+
+
+def _topFunctions(profiler):
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: -item[1][3])
+    return [['%s:%d(%s)' % func, nc, int(tt * 1000), int(ct * 1000)]
+            for func, (cc, nc, tt, ct, callers) in rows[:TOP_FUNCTIONS]]
+
+
+def _shouldProfile(environ):
+    if environ.get('PATH_INFO', '').startswith('/admin/'):
+        return False
+    config = getConfig()
+    if not config:
+        return False
+    return (bool(environ.get(PROFILE_HEADER)) or
+            random.random() < config['sampleRate'])
+
+
+class ProfilingMiddleware(object):
+    """Wrap a WSGI application so sampled requests are profiled.
+
+    Other attributes are those of the wrapped application, so e.g.
+    webapp2's get_response still works (unprofiled) in local tools.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+    def __call__(self, environ, start_response):
+        if not _shouldProfile(environ):
+            return self.app(environ, start_response)
+        _installHooks()
+        status = []
+
+        def recordStatus(stat, headers, exc_info=None):
+            status.append(stat)
+            return start_response(stat, headers, exc_info)
+
+        profiler = cProfile.Profile()
+        origin = time.time()
+        _local.rpcs = {'origin': origin, 'started': {}, 'timeline': []}
+        try:
+            # materialize the body so lazy responses are profiled too
+            body = list(profiler.runcall(self.app, environ, recordStatus))
+        finally:
+            timeline = _local.rpcs['timeline']
+            _local.rpcs = None
+        try:
+            ProfileReport(
+                path=environ.get('PATH_INFO'),
+                totalMs=int((time.time() - origin) * 1000),
+                report={'status': status[0] if status else None,
+                        'functions': _topFunctions(profiler),
+                        'rpcs': timeline}).put()
+        except Exception:
+            # a lost report must never fail the request
+            logging.warning('could not store profile report', exc_info=True)
+        return body
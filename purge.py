@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+purge.py -- Udacity conference server-side Python App Engine
+    cascade deletion of deleted conferences and their sessions, in
+    batches that can be resumed after an interruption
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import profilecache
+import speakercounts
+from models import Conference
+from models import Profile
+from models import Session
+from models import WaitlistEntry
+
+# largest IN filter the datastore accepts; sessions are purged this many
+# at a time so one IN query covers a whole batch
+PURGE_BATCH_SIZE = 30
+# one cross-group transaction may touch at most 25 entity groups
+PROFILE_BATCH_SIZE = 25
+STAGE_SESSIONS = 'sessions'
+STAGE_ATTENDEES = 'attendees'
+STAGE_CONFERENCE = 'conference'
+
+
+def enqueuePurge(c_key, stage=STAGE_SESSIONS, cursor=None,
+                 transactional=False):
+    """Run the next batch of a conference purge in the background."""
+    params = {'c_key_str': c_key.urlsafe(), 'stage': stage}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(params=params, url='/tasks/purge_conference',
+                  transactional=transactional)
+
+
+@ndb.transactional(xg=True)
+def _removeFromProfiles(p_keys, prop, websafeKeys):
+    """Drop websafe keys from a profile list property, re-read here."""
+    changed = []
+    for prof in ndb.get_multi(p_keys):
+        if prof is None:
+            continue
+        values = getattr(prof, prop)
+        kept = [wsk for wsk in values if wsk not in websafeKeys]
+        if len(kept) != len(values):
+            setattr(prof, prop, kept)
+            changed.append(prof)
+            profilecache.invalidate(prof.key)
+    ndb.put_multi(changed)
+
+
+def pruneProfiles(prop, websafeKeys, cursor=None):
+    """Remove up to 30 websafe keys from one page of profiles.
+
+    Returns the cursor of the next page, or None when done.
+    """
+    # IN queries only page with cursors when ordered by key
+    query = Profile.query(getattr(Profile, prop).IN(websafeKeys)).order(
+        Profile.key)
+    p_keys, next_cursor, more = query.fetch_page(
+        PROFILE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    if p_keys:
+        _removeFromProfiles(p_keys, prop, set(websafeKeys))
+    return next_cursor if more else None
+
+
+def purgeStep(c_key, stage=STAGE_SESSIONS, cursor=None):
+    """Run one batch of the purge of a deleted conference.
+
+    Returns (stage, cursor) of the next batch, or None when the purge is
+    done. Every batch can be repeated, so an interrupted purge restarted
+    from any earlier batch, or from the beginning, still finishes.
+    """
+    conf = c_key.get()
+    if conf is None or not conf.deleted:
+        return None
+
+    if stage == STAGE_SESSIONS:
+        # the sessions left are the ones still to do, so the first page of
+        # the ancestor query is always the current batch
+        sessions = Session.query(ancestor=c_key).fetch(PURGE_BATCH_SIZE)
+        s_keys = [sess.key for sess in sessions]
+        if not s_keys:
+            return STAGE_ATTENDEES, None
+        # wishlists go first; if the task dies before the delete, the next
+        # run sees the same batch again
+        cursor = pruneProfiles('wishlistSessionsKeys',
+                               [s_key.urlsafe() for s_key in s_keys], cursor)
+        if cursor:
+            return STAGE_SESSIONS, cursor
+        ndb.delete_multi(s_keys)
+        deltas = speakercounts.conferenceDeltasAsync(
+            c_key, speakercounts.sessionDeltas(sessions, -1), s_keys)
+        # a run that dies here leaves the counters high until the repair
+        taskqueue.Queue().add(speakercounts.updateTask(deltas.get_result()))
+        return STAGE_SESSIONS, None
+
+    if stage == STAGE_ATTENDEES:
+        cursor = pruneProfiles('conferenceKeysToAttend', [c_key.urlsafe()],
+                               cursor)
+        if cursor:
+            return STAGE_ATTENDEES, cursor
+        return STAGE_CONFERENCE, None
+
+    # last the conference itself, with its seats, stats and anything else
+    # kept under it, and its waitlist
+    entries = WaitlistEntry.query(
+        WaitlistEntry.conference == c_key).fetch(keys_only=True)
+    ndb.delete_multi(ndb.Query(ancestor=c_key).fetch(keys_only=True) +
+                     entries)
+    return None
+
+
+def sweepDeleted():
+    """Restart the purge of every conference still marked deleted."""
+    for c_key in Conference.query(Conference.deleted == True).fetch(
+            keys_only=True):
+        enqueuePurge(c_key)
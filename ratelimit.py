@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+ratelimit.py -- Udacity conference server-side Python App Engine
+    admission control; token buckets per user and per client, held in
+    memcache and handed out to instances in chunks
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import functools
+import os
+import threading
+import time
+
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.api import oauth
+
+from models import TooManyRequestsException
+from settings import RATE_LIMIT_CAPACITY
+from settings import RATE_LIMIT_CHUNK
+from settings import RATE_LIMIT_CLIENT_CAPACITY
+from settings import RATE_LIMIT_COSTS
+from settings import RATE_LIMIT_WINDOW
+from utils import getUserId
+
+MEMCACHE_RATE_LIMIT_TPL = "RATELIMIT:%s:%d"
+
+
+class _LocalTokens(object):
+    """Tokens this instance has already reserved, per bucket."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def take(self, bucket, window, cost):
+        """Spend cost local tokens if there are enough; return success."""
+        with self._lock:
+            tokens, tokensWindow = self._tokens.get(bucket, (0, window))
+            if tokensWindow != window:
+                tokens = 0
+            if tokens < cost:
+                return False
+            self._tokens[bucket] = (tokens - cost, window)
+            return True
+
+    def add(self, bucket, window, tokens):
+        with self._lock:
+            held, heldWindow = self._tokens.get(bucket, (0, window))
+            if heldWindow != window:
+                held = 0
+            self._tokens[bucket] = (held + tokens, window)
+
+
+_LOCAL = _LocalTokens()
+
+
+def _reserve(bucket, capacity, window, amount):
+    """Reserve up to amount tokens of the bucket from memcache.
+
+    The memcache counter holds the tokens handed out in this window, so one
+    incr both reserves and tells whether the bucket was already empty.
+    """
+    key = MEMCACHE_RATE_LIMIT_TPL % (bucket, window)
+    used = memcache.incr(key, delta=amount)
+    if used is None:
+        # first reservation in this window; let the counter expire with it
+        if memcache.add(key, amount, time=RATE_LIMIT_WINDOW * 2):
+            used = amount
+        else:
+            used = memcache.incr(key, delta=amount)
+    if used is None:
+        # memcache is unavailable; fail open rather than reject everyone
+        return amount
+    return max(0, min(amount, capacity - (used - amount)))
+
+
+def _take(bucket, capacity, window, cost):
+    """Spend cost tokens of the bucket; return success."""
+    if _LOCAL.take(bucket, window, cost):
+        return True
+    granted = _reserve(bucket, capacity, window, max(RATE_LIMIT_CHUNK, cost))
+    _LOCAL.add(bucket, window, granted)
+    return _LOCAL.take(bucket, window, cost)
+
+
+def _admit(buckets, cost):
+    """Return True if every (bucket, capacity) can pay for a call of the
+    given cost; a rejected call is charged to none of them."""
+    window = int(time.time()) // RATE_LIMIT_WINDOW
+    paid = []
+    for bucket, capacity in buckets:
+        if not _take(bucket, capacity, window, cost):
+            # the tokens already spent stay reserved by this instance, so
+            # they go back to its local stock
+            for paidBucket in paid:
+                _LOCAL.add(paidBucket, window, cost)
+            return False
+        paid.append(bucket)
+    return True
+
+
+def _callerBuckets():
+    """Return the (bucket, capacity) pairs the current caller is charged
+    against."""
+    buckets = []
+    user = endpoints.get_current_user()
+    if user:
+        buckets.append(('user:%s' % getUserId(user), RATE_LIMIT_CAPACITY))
+    try:
+        # cached by the runtime once endpoints has checked the token
+        buckets.append(('client:%s' % oauth.get_client_id(
+            endpoints.EMAIL_SCOPE), RATE_LIMIT_CLIENT_CAPACITY))
+    except oauth.Error:
+        # ID tokens and anonymous callers have no OAuth client ID
+        buckets.append(('addr:%s' % os.getenv('REMOTE_ADDR', ''),
+                        RATE_LIMIT_CAPACITY))
+    return buckets
+
+
+def rateLimited(name):
+    """Decorate an endpoint method so it is admitted before doing any work.
+
+    All limited endpoints draw on the same buckets; the cost of a call is
+    looked up by name in RATE_LIMIT_COSTS, and methods without a cost are
+    never limited.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, request):
+            cost = RATE_LIMIT_COSTS.get(name)
+            if cost and not _admit(_callerBuckets(), cost):
+                raise TooManyRequestsException(
+                    'Rate limit exceeded for %s; try again later.' % name)
+            return method(self, request)
+        return wrapper
+    return decorator
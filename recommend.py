@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+recommend.py -- Udacity conference server-side Python App Engine
+    "people who wishlisted this also wishlisted" recommendations, built
+    from wishlist co-occurrence by a periodic task per conference
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+from models import Session
+from models import SessionRecommendations
+from rekey import resolveKeys
+from settings import RECOMMENDATIONS_PER_SESSION
+
+PROFILE_BATCH_SIZE = 200
+# most tasks one Queue.add takes
+CONFERENCE_BATCH_SIZE = 100
+# largest IN filter the datastore accepts
+SESSION_IN_BATCH = 30
+
+
+def recommendationsKey(c_key):
+    """Return the key of a conference's session recommendations."""
+    return ndb.Key(SessionRecommendations, 1, parent=c_key)
+
+
+def enqueueBuilds(cursor=None):
+    """Enqueue a build task for each of one batch of conferences.
+
+    Returns the cursor of the next batch, or None when done.
+    """
+    c_keys, next_cursor, more = Conference.query().fetch_page(
+        CONFERENCE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    if c_keys:
+        taskqueue.Queue().add([taskqueue.Task(
+            params={'c_key_str': c_key.urlsafe()},
+            url='/tasks/build_recommendations') for c_key in c_keys])
+    return next_cursor if more else None
+
+
+def _collectBaskets(c_key):
+    """Return [[session id, ...]] for one conference.
+
+    Each basket is the part of one wishlist that falls in the conference;
+    only profiles wishlisting one of its sessions are read.
+    """
+    wssks = [s_key.urlsafe() for s_key in
+             Session.query(ancestor=c_key).fetch(keys_only=True)]
+    baskets = {}
+    for i in range(0, len(wssks), SESSION_IN_BATCH):
+        # IN queries only page with cursors when ordered by key
+        query = Profile.query(Profile.wishlistSessionsKeys.IN(
+            wssks[i:i + SESSION_IN_BATCH])).order(Profile.key)
+        cursor, more = None, True
+        while more:
+            profs, cursor, more = query.fetch_page(PROFILE_BATCH_SIZE,
+                                                   start_cursor=cursor)
+            for prof in profs:
+                if prof.key not in baskets:
+                    baskets[prof.key] = set(
+                        s_key.id() for s_key in
+                        resolveKeys(prof.wishlistSessionsKeys)
+                        if s_key.parent() == c_key)
+    # a single session co-occurs with nothing
+    return [list(s_ids) for s_ids in baskets.values() if len(s_ids) > 1]
+
+
+def topNeighbours(baskets, k):
+    """Return {session id: [[neighbour id, count], ...]} for one conference.
+
+    The counts come from the co-occurrence matrix C = B'B of the basket
+    by session incidence matrix B, computed in one vectorized step.
+    """
+    # numpy is only loaded by the build tasks, not by every API instance
+    import numpy
+
+    s_ids = sorted(set(s_id for basket in baskets for s_id in basket))
+    column = dict((s_id, i) for i, s_id in enumerate(s_ids))
+    incidence = numpy.zeros((len(baskets), len(s_ids)), dtype=numpy.int32)
+    rows = numpy.repeat(numpy.arange(len(baskets)),
+                        [len(basket) for basket in baskets])
+    cols = numpy.array([column[s_id] for basket in baskets
+                        for s_id in basket], dtype=numpy.intp)
+    incidence[rows, cols] = 1
+    cooccur = numpy.dot(incidence.T, incidence)
+    # a session is not its own neighbour
+    numpy.fill_diagonal(cooccur, 0)
+    # highest counts first; the stable sort breaks ties by session order
+    order = numpy.argsort(-cooccur, axis=1, kind='mergesort')[:, :k]
+    neighbours = {}
+    for i, s_id in enumerate(s_ids):
+        top = [[s_ids[j], int(cooccur[i, j])] for j in order[i]
+               if cooccur[i, j] > 0]
+        if top:
+            neighbours[str(s_id)] = top
+    return neighbours
+
+
+def buildRecommendations(c_key):
+    """Recompute the recommendations of one conference.
+
+    Conferences without wishlists, and deleted ones, lose the
+    recommendations they had. Returns True if any were stored.
+    """
+    conf = c_key.get()
+    baskets = _collectBaskets(c_key) if conf and not conf.deleted else []
+    if not baskets:
+        recommendationsKey(c_key).delete()
+        return False
+    SessionRecommendations(
+        key=recommendationsKey(c_key),
+        neighbours=topNeighbours(baskets, RECOMMENDATIONS_PER_SESSION)
+    ).put()
+    return True
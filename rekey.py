@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+rekey.py -- Udacity conference server-side Python App Engine
+    root-level conference keys; resolves old websafe keys through the
+    redirect map and moves conferences out of their organizer's group
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+import profilecache
+import waitlist
+from models import Conference
+from models import ConferenceSeats
+from models import ConferenceStats
+from models import KeyRedirect
+from models import Profile
+from models import Session
+from models import SessionRecommendations
+from models import WaitlistEntry
+from settings import CONFERENCE_KEY_LAYOUT
+
+ROOT_LAYOUT = 'root'
+# largest IN filter the datastore accepts
+PROFILE_IN_BATCH = 30
+PROFILE_BATCH_SIZE = 100
+
+
+def newConferenceKey(organizerKey):
+    """Allocate the key of a new conference in the configured layout."""
+    if CONFERENCE_KEY_LAYOUT == ROOT_LAYOUT:
+        return ndb.Key(Conference, Conference.allocate_ids(size=1)[0])
+    c_id = Conference.allocate_ids(size=1, parent=organizerKey)[0]
+    return ndb.Key(Conference, c_id, parent=organizerKey)
+
+
+def _mayBeMoved(key):
+    """True for conference and session keys from the organizer layout."""
+    conf_key = key if key.kind() == Conference._get_kind() else key.parent()
+    return (CONFERENCE_KEY_LAYOUT == ROOT_LAYOUT and conf_key is not None and
+            conf_key.kind() == Conference._get_kind() and
+            conf_key.parent() is not None)
+
+
+def _decodeKey(websafeKey):
+    # a malformed string fails at whichever decoding step it breaks
+    try:
+        return ndb.Key(urlsafe=websafeKey)
+    except (ProtocolBufferDecodeError, TypeError, AttributeError):
+        raise ValueError('Not a valid key: %s' % websafeKey)
+
+
+def isWebsafeKey(websafeKey):
+    """True if websafeKey decodes to a key."""
+    try:
+        _decodeKey(websafeKey)
+    except ValueError:
+        return False
+    return True
+
+
+def resolveKeys(websafeKeys):
+    """Return the current keys for websafe keys, following redirects.
+
+    Only keys of the old layout are looked up, all in one batch get, so in
+    the organizer layout this never touches the datastore. Raises
+    ValueError for a string that is not a websafe key.
+    """
+    keys = [_decodeKey(wsk) for wsk in websafeKeys]
+    moved = [i for i, key in enumerate(keys) if _mayBeMoved(key)]
+    if moved:
+        redirects = ndb.get_multi([ndb.Key(KeyRedirect, websafeKeys[i]) for i
+                                   in moved])
+        for i, redirect in zip(moved, redirects):
+            if redirect:
+                keys[i] = redirect.newKey
+    return keys
+
+
+def resolveKey(websafeKey):
+    """Return the current key for a websafe key, following redirects."""
+    return resolveKeys([websafeKey])[0]
+
+
+def _redirectFor(old_key):
+    """Return the new key of a conference, allocating it once."""
+    # ids can't be allocated inside a transaction; one allocated for a
+    # redirect that turns out to exist is simply never used
+    c_id = Conference.allocate_ids(size=1)[0]
+
+    @ndb.transactional
+    def redirect():
+        redirect_key = ndb.Key(KeyRedirect, old_key.urlsafe())
+        redirect = redirect_key.get()
+        if redirect is None:
+            redirect = KeyRedirect(key=redirect_key,
+                                   newKey=ndb.Key(Conference, c_id))
+            redirect.put()
+        return redirect.newKey
+    return redirect()
+
+
+def _rewriteProfiles(prop, mapping):
+    """Replace old websafe keys by new ones in a profile list property."""
+    old_keys = mapping.keys()
+    for i in range(0, len(old_keys), PROFILE_IN_BATCH):
+        batch = old_keys[i:i + PROFILE_IN_BATCH]
+        # IN queries only page with cursors when ordered by key
+        query = Profile.query(getattr(Profile, prop).IN(batch)).order(
+            Profile.key)
+        cursor, more = None, True
+        while more:
+            profs, cursor, more = query.fetch_page(PROFILE_BATCH_SIZE,
+                                                   start_cursor=cursor)
+            for prof in profs:
+                setattr(prof, prop, [mapping.get(wsk, wsk) for wsk in
+                                     getattr(prof, prop)])
+                profilecache.invalidate(prof.key)
+            ndb.put_multi(profs)
+
+
+def moveConference(old_key):
+    """Move one conference, its seats, stats, recommendations, sessions
+    and waitlist to a root key.
+
+    Every step can be repeated, so a failed task simply runs again: the new
+    key is fixed by the redirect written first, copies are puts to fixed
+    keys and the old entities are deleted last. Registrations on the old
+    key while a move is in flight can be lost, so run this when quiet.
+    """
+    new_key = _redirectFor(old_key)
+    conf, seats, stats, recs = ndb.get_multi([
+        old_key, ndb.Key(ConferenceSeats, 1, parent=old_key),
+        ndb.Key(ConferenceStats, 1, parent=old_key),
+        ndb.Key(SessionRecommendations, 1, parent=old_key)])
+    if conf is None:
+        return new_key
+    sessions = Session.query(ancestor=old_key).fetch()
+    entries = WaitlistEntry.query(WaitlistEntry.conference == old_key).fetch()
+
+    copies = [Conference(key=new_key, **conf.to_dict())]
+    if seats:
+        copies.append(ConferenceSeats(key=ndb.Key(
+            ConferenceSeats, 1, parent=new_key), **seats.to_dict()))
+    if stats:
+        copies.append(ConferenceStats(key=ndb.Key(
+            ConferenceStats, 1, parent=new_key), **stats.to_dict()))
+    # the table is keyed by session id, and sessions keep their ids
+    if recs:
+        copies.append(SessionRecommendations(key=ndb.Key(
+            SessionRecommendations, 1, parent=new_key), **recs.to_dict()))
+    mapping = {old_key.urlsafe(): new_key.urlsafe()}
+    session_mapping = {}
+    redirects = []
+    for sess in sessions:
+        new_sess_key = ndb.Key(Session, sess.key.id(), parent=new_key)
+        copies.append(Session(key=new_sess_key, **sess.to_dict()))
+        session_mapping[sess.key.urlsafe()] = new_sess_key.urlsafe()
+        redirects.append(KeyRedirect(id=sess.key.urlsafe(),
+                                     newKey=new_sess_key))
+    # sessions keep their ids, which the new group has never handed out;
+    # reserving them keeps sessions created later from taking one over
+    if sessions:
+        Session.allocate_ids(max=max(sess.key.id() for sess in sessions),
+                             parent=new_key)
+    # waitlist entries are keyed by the conference; their created time is
+    # kept, so everybody keeps their place
+    for entry in entries:
+        values = entry.to_dict()
+        values['conference'] = new_key
+        copies.append(WaitlistEntry(
+            key=waitlist.entryKey(new_key, entry.userId), **values))
+    ndb.put_multi(copies + redirects)
+
+    _rewriteProfiles('conferenceKeysToAttend', mapping)
+    _rewriteProfiles('wishlistSessionsKeys', session_mapping)
+    ndb.delete_multi([old_key] +
+                     [ent.key for ent in [seats, stats, recs] if ent] +
+                     [sess.key for sess in sessions] +
+                     [entry.key for entry in entries])
+    return new_key
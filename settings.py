@@ -17,3 +17,62 @@ WEB_CLIENT_ID = '31419595681-pt768mjaif1fqmcpg49keo6kfkesilo1.apps.googleusercon
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Mail outbox: maximum number of emails the outbox worker sends per run
+# (the worker runs once a minute from cron), how many queued notices it
+# leases per organizer at a time and how many times a notice is leased
+# for a send that fails before it is dropped.
+MAIL_SENDS_PER_RUN = 60
+MAIL_LEASE_BATCH_SIZE = 100
+MAIL_MAX_ATTEMPTS = 5
+
+# Rate limiting for expensive endpoints: every user (or address, for
+# anonymous callers) gets RATE_LIMIT_CAPACITY tokens per RATE_LIMIT_WINDOW
+# seconds and every OAuth client RATE_LIMIT_CLIENT_CAPACITY; all users of
+# the web client share its bucket. Each call costs the weight listed in
+# RATE_LIMIT_COSTS; instances reserve tokens from memcache
+# RATE_LIMIT_CHUNK at a time so most checks stay local.
+RATE_LIMIT_CAPACITY = 120
+RATE_LIMIT_CLIENT_CAPACITY = 60000
+RATE_LIMIT_WINDOW = 60
+RATE_LIMIT_CHUNK = 20
+RATE_LIMIT_COSTS = {
+    'queryConferences': 5,
+    'getConferenceSessions': 3,
+    'getConferenceSessionsByType': 2,
+    'getSessionsBySpeaker': 5,
+}
+
+# Where new conferences are created: 'organizer' keeps each Conference as
+# a child of its organizer's Profile (one entity group per organizer);
+# 'root' makes each Conference the root of its own entity group. Existing
+# data is moved with the /tasks/rekey_conferences migration.
+CONFERENCE_KEY_LAYOUT = 'organizer'
+
+# Transaction retry policies per call site (see txstats.py): how often a
+# transaction that collided with another writer is retried, the backoff
+# before the first retry in seconds (doubled each retry, with jitter) and
+# its cap. Sites not listed use 'default'. /admin/txstats shows how each
+# site behaves under real traffic.
+TX_RETRY_POLICIES = {
+    'default': {'retries': 3, 'backoff': 0.1, 'maxBackoff': 1.0},
+    # many users register for one popular conference at the same time
+    'registration': {'retries': 5, 'backoff': 0.05, 'maxBackoff': 0.8},
+    'addSessionToWishlist': {'retries': 3, 'backoff': 0.05,
+                             'maxBackoff': 0.4},
+    'updateConference': {'retries': 3, 'backoff': 0.1, 'maxBackoff': 1.0},
+}
+
+# Hot-key protection: the announcement and featured-speaker entries are
+# written under this many memcache keys and read from one at random, so a
+# single hot key is spread over several memcache servers.
+HOT_KEY_REPLICAS = 1
+
+# Session recommendations: how many sessions most often wishlisted together
+# with a session are kept for it by the nightly co-occurrence job.
+RECOMMENDATIONS_PER_SESSION = 5
+
+# Profile cache: how long an instance may serve a user's Profile from
+# memory. Writes on the same instance drop it at once; other instances
+# catch up within this many seconds.
+PROFILE_CACHE_SECONDS = 10
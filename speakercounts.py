@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+speakercounts.py -- Udacity conference server-side Python App Engine
+    sharded counters of sessions, conferences and upcoming sessions per
+    speaker across all conferences, and the leaderboard built from them
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import collections
+import json
+import zlib
+from datetime import date
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import CounterUpdate
+from models import Session
+from models import Speaker
+from models import SpeakerCounterShard
+
+SPEAKER_SHARDS = 10
+MEMCACHE_TOP_SPEAKERS_KEY = "TOP_SPEAKERS"
+# bounds how long the leaderboard lags behind the counters
+MEMCACHE_TOP_SPEAKERS_SECONDS = 300
+REPAIR_BATCH_SIZE = 20
+
+
+def isUpcoming(sess, today=None):
+    """Return True if a session has not happened yet."""
+    return sess.date is not None and sess.date >= (today or date.today())
+
+
+def sessionDeltas(sessions, sign):
+    """Return [speaker id, sessions, upcoming] changes for sessions added
+    (sign 1) or removed (sign -1)."""
+    today = date.today()
+    deltas = collections.defaultdict(lambda: [0, 0])
+    for sess in sessions:
+        for spkr_key in sess.speakers:
+            deltas[spkr_key.id()][0] += sign
+            if isUpcoming(sess, today):
+                deltas[spkr_key.id()][1] += sign
+    return [[speakerId, count, upcoming] for speakerId, (count, upcoming)
+            in deltas.items()]
+
+
+@ndb.tasklet
+def conferenceDeltasAsync(c_key, deltas, s_keys):
+    """Return deltas with each speaker's change in conferences appended.
+
+    A speaker gains c_key when the sessions s_keys being added are the
+    only ones they have there, and loses it when none are left once
+    s_keys are removed. s_keys are left out of the count, so this may run
+    alongside their put or delete; it has to run in the request writing
+    them, as a task run later sees sessions added since. Two requests
+    for the same speaker and conference at once can both miss the
+    change; the nightly repair puts it right.
+    """
+    s_keys = set(s_keys)
+    # ancestor queries are strongly consistent
+    others = yield [Session.query(
+        Session.speakers == ndb.Key(Speaker, speakerId),
+        ancestor=c_key).fetch_async(len(s_keys) + 1, keys_only=True)
+        for speakerId, count, upcoming in deltas]
+    raise ndb.Return([
+        [speakerId, count, upcoming,
+         0 if set(keys) - s_keys else (1 if count > 0 else -1)]
+        for (speakerId, count, upcoming), keys in zip(deltas, others)])
+
+
+def updateTask(deltas):
+    """Return the task applying conferenceDeltasAsync deltas."""
+    return taskqueue.Task(params={'deltas': json.dumps(deltas)},
+                          url='/tasks/update_speaker_counts')
+
+
+def _shardKey(speakerId, shard):
+    return ndb.Key(SpeakerCounterShard, '%s|%d' % (speakerId, shard))
+
+
+def _shardKeys(speakerId):
+    return [_shardKey(speakerId, shard) for shard in range(SPEAKER_SHARDS)]
+
+
+@ndb.transactional_tasklet
+def _incrementShard(update_id, speakerId, sessions, conferences, upcoming):
+    # the task picks the shard, so a retry comes back to the shard it
+    # changed before and finds its marker there (see facets.py)
+    key = _shardKey(speakerId, zlib.crc32(update_id) % SPEAKER_SHARDS)
+    marker_key = ndb.Key(CounterUpdate, update_id, parent=key)
+    shard, marker = yield ndb.get_multi_async([key, marker_key])
+    if marker is not None:
+        return
+    if shard is None:
+        shard = SpeakerCounterShard(key=key,
+                                    speaker=ndb.Key(Speaker, speakerId))
+    shard.sessions += sessions
+    shard.conferences += conferences
+    shard.upcoming += upcoming
+    yield ndb.put_multi_async([shard, CounterUpdate(key=marker_key)])
+
+
+def applyDeltas(update_id, deltas):
+    """Apply the conferenceDeltasAsync of sessions just added or removed;
+    update_id names the task carrying them, and a retried task skips the
+    speakers it already counted."""
+    futures = [_incrementShard(update_id, speakerId, count, conferences,
+                               upcoming)
+               for speakerId, count, upcoming, conferences in deltas]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+
+
+def leaderboard():
+    """Return [[speaker id, sessions, conferences, upcoming]] for every
+    speaker with sessions, most sessions first."""
+    board = memcache.get(MEMCACHE_TOP_SPEAKERS_KEY)
+    if board is not None:
+        return board
+    totals = collections.defaultdict(lambda: [0, 0, 0])
+    for shard in SpeakerCounterShard.query():
+        total = totals[shard.speaker.id()]
+        total[0] += shard.sessions
+        total[1] += shard.conferences
+        total[2] += shard.upcoming
+    board = sorted(([speakerId] + total for speakerId, total in
+                    totals.items() if total[0] > 0),
+                   key=lambda row: (-row[1], -row[2], row[0]))
+    memcache.set(MEMCACHE_TOP_SPEAKERS_KEY, board,
+                 time=MEMCACHE_TOP_SPEAKERS_SECONDS)
+    return board
+
+
+def _totals(shards):
+    return [sum(getattr(shard, prop) for shard in shards if shard) for prop
+            in ('sessions', 'conferences', 'upcoming')]
+
+
+@ndb.transactional(xg=True)
+def _replaceShards(spkr_key, seen, exact):
+    """Replace a speaker's shards by one exact shard, unless an update has
+    changed them since they were seen; return True if replaced."""
+    keys = _shardKeys(spkr_key.id())
+    if _totals(ndb.get_multi(keys)) != seen:
+        return False
+    ndb.delete_multi(keys[1:])
+    exact.put()
+    return True
+
+
+def repairBatch(cursor=None):
+    """Recount one batch of speakers from their sessions.
+
+    Each speaker's shards are replaced by one exact shard; this also moves
+    sessions that have since taken place out of the upcoming count. The
+    shards are read before the sessions are queried, and a speaker whose
+    shards changed in between is left for the next repair, so no update
+    is overwritten. An update task still queued when its speaker is
+    replaced counts its sessions a second time, until the next repair.
+    Returns the cursor of the next batch, or None when done.
+    """
+    s_keys, next_cursor, more = Speaker.query().fetch_page(
+        REPAIR_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    shards = ndb.get_multi([key for spkr_key in s_keys for key in
+                            _shardKeys(spkr_key.id())])
+    futures = [Session.query(Session.speakers == spkr_key).fetch_async()
+               for spkr_key in s_keys]
+    today = date.today()
+    for i, (spkr_key, future) in enumerate(zip(s_keys, futures)):
+        sessions = future.get_result()
+        seen = _totals(shards[i * SPEAKER_SHARDS:(i + 1) * SPEAKER_SHARDS])
+        _replaceShards(spkr_key, seen, SpeakerCounterShard(
+            key=_shardKey(spkr_key.id(), 0), speaker=spkr_key,
+            sessions=len(sessions),
+            conferences=len(set(sess.key.parent() for sess in sessions)),
+            upcoming=sum(1 for sess in sessions if isUpcoming(sess, today))))
+    return next_cursor if more else None
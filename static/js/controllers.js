@@ -249,7 +249,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $http, $q, oauth2Provider, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -424,7 +424,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Queries all conferences with the filters set; without filters the listing
+     * comes from the catalog snapshot.
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
@@ -440,6 +441,51 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
+        if (sendFilters.filters.length == 0) {
+            $scope.queryCatalogSnapshot(sendFilters);
+            return;
+        }
+        $scope.queryConferencesApi(sendFilters);
+    };
+
+    /**
+     * Loads the unfiltered listing from the catalog snapshot: a small version pointer and
+     * its pages, which the server and the browser cache. Falls back to the
+     * conference.queryConferences API when there is no snapshot.
+     */
+    $scope.queryCatalogSnapshot = function (sendFilters) {
+        $scope.loading = true;
+        $http.get('/catalog/current.json').
+            then(function (resp) {
+                var pages = [];
+                for (var i = 0; i < resp.data.chunks; i++) {
+                    pages.push($http.get('/catalog/' + resp.data.version + '/' + i + '.json',
+                        {cache: true}));
+                }
+                return $q.all(pages);
+            }).
+            then(function (pages) {
+                $scope.loading = false;
+                $scope.messages = 'Query succeeded : ' + JSON.stringify(sendFilters);
+                $scope.alertStatus = 'success';
+                $log.info($scope.messages);
+                $scope.conferences = [];
+                angular.forEach(pages, function (page) {
+                    angular.forEach(page.data.items, function (conference) {
+                        $scope.conferences.push(conference);
+                    });
+                });
+                $scope.submitted = true;
+            }, function () {
+                $log.info('No catalog snapshot; querying the API');
+                $scope.queryConferencesApi(sendFilters);
+            });
+    };
+
+    /**
+     * Invokes the conference.queryConferences API with the given filters.
+     */
+    $scope.queryConferencesApi = function (sendFilters) {
         $scope.loading = true;
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
@@ -554,19 +600,28 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.batch method, which returns the conference and the user's profile
+     * in one round trip, and sets the returned conference in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
-            websafeConferenceKey: $routeParams.websafeConferenceKey
+        gapi.client.conference.batch({
+            requests: [
+                {
+                    method: 'getConference',
+                    params: JSON.stringify({websafeConferenceKey: $routeParams.websafeConferenceKey})
+                },
+                {method: 'getProfile'}
+            ]
         }).execute(function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
-                if (resp.error) {
+                var conference = resp.error ? resp : resp.result.responses[0];
+                var profile = resp.error ? resp : resp.result.responses[1];
+                if (conference.error) {
                     // The request has failed.
-                    var errorMessage = resp.error.message || '';
+                    var errorMessage = conference.error.message || conference.error;
                     $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeKey
                         + ' ' + errorMessage;
                     $scope.alertStatus = 'warning';
@@ -574,22 +629,17 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     // The request has succeeded.
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
+                    $scope.conference = JSON.parse(conference.result);
                 }
-            });
-        });
 
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
+                // If the user is attending the conference, updates the status message and available function.
+                if (profile.error) {
                     // Failed to get a user profile.
                 } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
+                    profile = JSON.parse(profile.result);
+                    var conferenceKeysToAttend = profile.conferenceKeysToAttend || [];
+                    for (var i = 0; i < conferenceKeysToAttend.length; i++) {
+                        if ($routeParams.websafeConferenceKey == conferenceKeysToAttend[i]) {
                             // The user is attending the conference.
                             $scope.alertStatus = 'info';
                             $scope.messages = 'You are attending this conference';
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+stats.py -- Udacity conference server-side Python App Engine
+    per-conference session statistics, recomputed by coalesced tasks
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import collections
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceStats
+from models import Session
+
+# sessions created within one window share a single recompute task
+STATS_WINDOW = 10
+REPAIR_BATCH_SIZE = 20
+
+
+def statsKey(c_key):
+    """Return the key of a conference's session statistics."""
+    return ndb.Key(ConferenceStats, 1, parent=c_key)
+
+
+def _taskName(c_key, window):
+    # websafe keys only use [A-Za-z0-9_-], which task names allow
+    return 'stats-%s-%d' % (c_key.urlsafe(), window)
+
+
+def enqueueRecomputeAsync(c_key):
+    """Schedule a recompute at the end of the current window.
+
+    Returns an RPC for checkRecomputeRpc. Every session created in the
+    same window asks for the same task name, so the conference is
+    recomputed once per window however many sessions are added.
+    """
+    now = time.time()
+    window = int(now) // STATS_WINDOW
+    task = taskqueue.Task(
+        name=_taskName(c_key, window),
+        params={'c_key_str': c_key.urlsafe()},
+        url='/tasks/update_conference_stats',
+        countdown=(window + 1) * STATS_WINDOW - now + 1)
+    return taskqueue.Queue().add_async(task)
+
+
+def checkRecomputeRpc(rpc):
+    """Wait for enqueueRecomputeAsync; a task for the window may exist."""
+    try:
+        rpc.get_result()
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def computeStats(c_key, sessions):
+    """Return a ConferenceStats computed from all sessions of c_key."""
+    byType = collections.Counter()
+    byDay = collections.Counter()
+    speakers = set()
+    totalMinutes = 0
+    for sess in sessions:
+        byType[sess.typeOfSession or 'NOT_SPECIFIED'] += 1
+        if sess.date:
+            byDay[str(sess.date)] += 1
+        speakers.update(sess.speakers)
+        if sess.duration:
+            totalMinutes += sess.duration.hour * 60 + sess.duration.minute
+    return ConferenceStats(key=statsKey(c_key),
+                           sessionCount=sum(byType.values()),
+                           sessionsByType=dict(byType),
+                           sessionsByDay=dict(byDay),
+                           speakerCount=len(speakers),
+                           totalMinutes=totalMinutes)
+
+
+@ndb.transactional
+def recompute(c_key):
+    """Recompute and store the statistics of one conference.
+
+    The ancestor query and the put run in one transaction on the
+    conference's group, so an older recompute can never overwrite a newer
+    one. Returns None if the conference no longer exists.
+    """
+    if c_key.get() is None:
+        return None
+    stats = computeStats(c_key, Session.query(ancestor=c_key).fetch())
+    stats.put()
+    return stats
+
+
+def repairBatch(cursor=None):
+    """Recompute the stats of one batch of conferences.
+
+    Returns the cursor to continue from, or None when done.
+    """
+    c_keys, next_cursor, more = Conference.query().fetch_page(
+        REPAIR_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    for c_key in c_keys:
+        recompute(c_key)
+    return next_cursor if more else None
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+bench_mail.py -- measure mail outbox throughput against the local mail stub
+
+usage: python tools/bench_mail.py [notices] [organizers]
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tools import harness
+
+
+def main(notices=1000, organizers=50):
+    tb = harness.activateTestbed()
+    import outbox
+    mail_stub = tb.get_stub('mail')
+
+    start = time.time()
+    for i in range(notices):
+        outbox.enqueueConfirmation('organizer%d@example.com' % (
+            i % organizers), 'Conference %d' % i)
+    enqueued = time.time() - start
+
+    runs = sent = drained = 0
+    start = time.time()
+    while drained < notices:
+        run_sent, run_notices = outbox.drainOutbox()
+        if not run_notices:
+            break
+        runs += 1
+        sent += run_sent
+        drained += run_notices
+    elapsed = time.time() - start
+
+    print 'notices enqueued:   %d in %.2fs (%.0f/s)' % (
+        notices, enqueued, notices / max(enqueued, 1e-6))
+    print 'notices drained:    %d in %d worker runs' % (drained, runs)
+    print 'emails sent:        %d (stub saw %d)' % (
+        sent, len(mail_stub.get_sent_messages()))
+    print 'coalescing factor:  %.1f notices/email' % (
+        drained / float(max(sent, 1)))
+    print 'drain throughput:   %.0f notices/s' % (
+        drained / max(elapsed, 1e-6))
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+bench_startup.py -- measure cold-start import and first-request latency of
+    main.app, and the import of conference.api, in fresh interpreters
+
+usage: python tools/bench_startup.py [runs]
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tools import harness
+
+# run in child processes so every sample starts from an empty module cache
+SETUP = r'''
+import json, sys, time
+sys.path.insert(0, %(root)r)
+from tools import harness
+harness.fixSysPath()
+tb = harness.activateTestbed()
+import webapp2
+'''
+# main.app and its warmup request; the warmup imports the API
+MAIN_CHILD = SETUP + r'''
+t0 = time.time()
+import main
+t1 = time.time()
+main.app.get_response('/_ah/warmup')
+t2 = time.time()
+print json.dumps({'import_main': t1 - t0, 'warmup': t2 - t1,
+                  'total': t2 - t0})
+'''
+# conference.api on its own, as an instance serving /_ah/spi loads it
+API_CHILD = SETUP + r'''
+t0 = time.time()
+import conference
+print json.dumps({'import_conference': time.time() - t0})
+'''
+
+
+def _run(child):
+    out = subprocess.check_output([sys.executable, '-c', child % {
+        'root': harness.ROOT}])
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def sample():
+    timings = _run(MAIN_CHILD)
+    timings.update(_run(API_CHILD))
+    return timings
+
+
+def main(runs=20):
+    samples = [sample() for _ in range(runs)]
+    print '%-18s %8s %8s %8s' % ('phase (ms)', 'p50', 'p90', 'p99')
+    for phase in ('import_main', 'warmup', 'total', 'import_conference'):
+        values = [s[phase] * 1000 for s in samples]
+        print '%-18s %8.1f %8.1f %8.1f' % (
+            phase, harness.percentile(values, 50),
+            harness.percentile(values, 90), harness.percentile(values, 99))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+harness.py -- shared setup for the local benchmark and analysis tools;
+    puts the App Engine SDK on sys.path and activates the service stubs
+
+Set GAE_SDK to the SDK directory if it is not installed in the default
+location. The tools directory is excluded from deployment in app.yaml.
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SDK = os.environ.get('GAE_SDK', '/usr/local/google_appengine')
+
+
+def fixSysPath():
+    """Make the SDK libraries and the app modules importable."""
+    if SDK not in sys.path:
+        sys.path.insert(0, SDK)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def activateTestbed(consistency=None, require_indexes=False,
+                    indexRoot=None):
+    """Activate a testbed with every stub the app touches and return it.
+
+    With require_indexes, queries need an index in indexRoot/index.yaml
+    (the app's own index.yaml by default).
+    """
+    fixSysPath()
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    # endpoints reads the deployed revision from '<version>.<revision>'
+    tb.setup_env(current_version_id='testbed.1', overwrite=True)
+    tb.init_datastore_v3_stub(consistency_policy=consistency,
+                              require_indexes=require_indexes,
+                              root_path=indexRoot or ROOT)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=ROOT)
+    tb.init_mail_stub()
+    tb.init_app_identity_stub()
+    tb.init_user_stub()
+    tb.init_urlfetch_stub()
+    ndb.get_context().clear_cache()
+    return tb
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of values (nearest rank)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
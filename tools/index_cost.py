@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""
+index_cost.py -- record the Conference query shapes ConferenceApi._getQuery
+    issues, estimate the index rows written per Conference for an index
+    set, propose the smallest composite set that serves every shape through
+    merge-joins, and check on the datastore stub that every shape runs
+
+usage: python tools/index_cost.py [max_topics]
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tools import harness
+
+# a sample value per filter field, as the web client would send it
+SAMPLE_VALUES = {
+    'CITY': 'London',
+    'TOPIC': 'Web Technologies',
+    'MONTH': '6',
+    'MAX_ATTENDEES': '50',
+}
+
+
+def recordShapes():
+    """Run _getQuery for every filter combination; return shapes.
+
+    A shape is (equality properties, orders); combinations _formatFilters
+    rejects are returned separately.
+    """
+    import endpoints
+    from conference import ConferenceApi
+    from models import ConferenceQueryForm
+    from models import ConferenceQueryForms
+
+    api = ConferenceApi()
+    shapes, rejected = set(), []
+    fields = sorted(SAMPLE_VALUES)
+    for size in range(len(fields) + 1):
+        for eqFields in itertools.combinations(fields, size):
+            for ineqField in [None] + [f for f in fields if f not in
+                                       eqFields]:
+                filters = [ConferenceQueryForm(
+                    field=f, operator='EQ', value=SAMPLE_VALUES[f])
+                    for f in eqFields]
+                if ineqField:
+                    filters.append(ConferenceQueryForm(
+                        field=ineqField, operator='GT',
+                        value=SAMPLE_VALUES[ineqField]))
+                try:
+                    query = api._getQuery(ConferenceQueryForms(
+                        filters=filters))
+                except endpoints.BadRequestException:
+                    rejected.append((eqFields, ineqField))
+                    continue
+                shapes.add(shapeOf(query))
+    return sorted(shapes), rejected
+
+
+def shapeOf(query):
+    """Return (sorted equality properties, order properties) of a query."""
+    from google.appengine.ext import ndb
+    equalities, orders = set(), []
+    nodes = [query.filters] if query.filters else []
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, ndb.query.FilterNode):
+            if node._FilterNode__opsymbol == '=':
+                equalities.add(node._FilterNode__name)
+        else:
+            # conjunctions, and the disjunctions '!=' expands into
+            nodes.extend(node)
+    if query.orders is not None:
+        composite = getattr(query.orders, 'orders', [query.orders])
+        orders = [order.prop for order in composite]
+    return tuple(sorted(equalities - set(orders))), tuple(orders)
+
+
+def neededIndexes(shape):
+    """Return the composite indexes a shape needs with merge-joins."""
+    equalities, orders = shape
+    if not equalities:
+        # a single sort order is served by the built-in indexes
+        return [orders] if len(orders) > 1 else []
+    # every equality gets its own index ending in the shared sort order, so
+    # the datastore can zigzag across them
+    return [(prop,) + orders for prop in equalities]
+
+
+def proposeIndexes(shapes):
+    proposed = set()
+    for shape in shapes:
+        proposed.update(neededIndexes(shape))
+    return sorted(proposed, key=lambda idx: (len(idx), idx))
+
+
+def loadIndexes(path):
+    """Return the Conference composite indexes declared in index.yaml."""
+    from google.appengine.datastore import datastore_index
+    with open(path) as f:
+        definitions = datastore_index.ParseIndexDefinitions(f)
+    return [tuple(prop.name for prop in index.properties)
+            for index in definitions.indexes if index.kind == 'Conference']
+
+
+def rowsPerEntity(indexes, topics):
+    """Index rows one Conference with `topics` topics has in indexes."""
+    rows = 0
+    for index in indexes:
+        count = 1
+        for prop in index:
+            if prop == 'topics':
+                count *= topics
+        rows += count
+    return rows
+
+
+def writeIndexYaml(path, indexes, extra):
+    """Write an index.yaml with the given Conference indexes."""
+    with open(path, 'w') as f:
+        f.write('indexes:\n')
+        for kind, props in extra + [('Conference', idx) for idx in
+                                    indexes]:
+            f.write('\n- kind: %s\n  properties:\n' % kind)
+            for prop in props:
+                f.write('  - name: %s\n' % prop)
+
+
+def verify(indexes, shapes):
+    """Run every shape on a stub that requires the proposed indexes."""
+    from conference import ConferenceApi
+    from conference import FIELDS
+    from models import Conference
+    from models import ConferenceQueryForm
+    from models import ConferenceQueryForms
+
+    root = tempfile.mkdtemp()
+    writeIndexYaml(os.path.join(root, 'index.yaml'), indexes, [])
+    failures = []
+    try:
+        tb = harness.activateTestbed(require_indexes=True, indexRoot=root)
+        Conference(name='Sample', city='London', topics=[
+            'Web Technologies', 'Programming Languages'], month=6,
+            maxAttendees=50).put()
+        api = ConferenceApi()
+        fieldNames = dict((v, k) for k, v in FIELDS.items())
+        for shape in shapes:
+            equalities, orders = shape
+            filters = [ConferenceQueryForm(
+                field=fieldNames[prop], operator='EQ',
+                value=SAMPLE_VALUES[fieldNames[prop]]) for prop in
+                equalities]
+            if len(orders) > 1:
+                field = fieldNames[orders[0]]
+                filters.append(ConferenceQueryForm(
+                    field=field, operator='GT', value=SAMPLE_VALUES[field]))
+            try:
+                api._getQuery(ConferenceQueryForms(filters=filters)).fetch()
+            except Exception as e:
+                failures.append((shape, '%s: %s' % (
+                    e.__class__.__name__, str(e).splitlines()[0])))
+        tb.deactivate()
+    finally:
+        shutil.rmtree(root)
+    return failures
+
+
+def main(maxTopics=4):
+    tb = harness.activateTestbed()
+    shapes, rejected = recordShapes()
+    tb.deactivate()
+    current = loadIndexes(os.path.join(harness.ROOT, 'index.yaml'))
+    proposed = proposeIndexes(shapes)
+
+    print '%d query shapes issued by _getQuery:' % len(shapes)
+    for equalities, orders in shapes:
+        print '  filter =: %-40s order: %s' % (
+            ', '.join(equalities) or '-', ', '.join(orders))
+    print '%d filter combinations rejected by _formatFilters' % len(rejected)
+    print
+    print 'proposed Conference composite indexes (%d):' % len(proposed)
+    for index in proposed:
+        print '  (%s)' % ', '.join(index)
+    print
+    print '%-10s %10s %10s' % ('topics', 'current', 'proposed')
+    print '%-10s %10d %10d' % ('indexes', len(current), len(proposed))
+    for topics in range(1, maxTopics + 1):
+        print '%-10s %10d %10d' % (
+            '%d rows' % topics, rowsPerEntity(current, topics),
+            rowsPerEntity(proposed, topics))
+    print '(index rows written per Conference; an update that changes an'
+    print ' indexed value deletes and rewrites its rows)'
+    print
+
+    failures = verify(proposed, shapes)
+    if failures:
+        print 'shapes the proposed set cannot serve:'
+        for shape, error in failures:
+            print '  %s: %s' % (shape, error)
+        sys.exit(1)
+    print 'all %d shapes ran on the stub with only the proposed indexes' % (
+        len(shapes))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+loadtest.py -- drive many concurrent simulated users against ConferenceApi
+    on the local datastore stub; mixes browsing, queries, registrations and
+    wishlist writes, then checks that no conference was oversold
+
+usage: python tools/loadtest.py [users] [ops_per_user] [conferences]
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tools import harness
+
+# operation mix, as relative weights
+MIX = [
+    ('getConference', 25),
+    ('queryConferences', 15),
+    ('getConferenceSessions', 20),
+    ('registerForConference', 20),
+    ('unregisterFromConference', 5),
+    ('addSessionToWishlist', 10),
+    ('getProfile', 5),
+]
+SEATS_PER_CONFERENCE = 20
+SESSIONS_PER_CONFERENCE = 5
+# txstats call sites the mix goes through; registration covers both
+# registering and unregistering
+TX_SITES = ['registration', 'addSessionToWishlist']
+TX_COUNTS = ['calls', 'attempts', 'retries', 'failures']
+
+
+class FakeUser(object):
+    """Stand-in for users.User, as returned by endpoints.get_current_user."""
+
+    def __init__(self, email):
+        self._email = email
+
+    def email(self):
+        return self._email
+
+    def nickname(self):
+        return self._email.split('@')[0]
+
+
+class Stats(object):
+    """Thread-safe latency and outcome counters per operation."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+
+    def record(self, op, seconds, outcome):
+        with self.lock:
+            self.latency[op].append(seconds)
+            self.outcomes[op][outcome] += 1
+
+
+_local = threading.local()
+
+
+def _currentUser():
+    return getattr(_local, 'user', None)
+
+
+def txCounts():
+    """Return {site: Counter} of the txstats totals for TX_SITES."""
+    import txstats
+    sites = txstats.report()['sites']
+    counts = {}
+    for site in TX_SITES:
+        totals = sites.get(site, {})
+        counts[site] = collections.Counter(
+            dict((name, totals.get(name, 0)) for name in TX_COUNTS),
+            collisions=totals.get('collisions', {}).get(
+                'TransactionFailedError', 0))
+    return counts
+
+
+def seed(api, conferences):
+    """Create conferences with sessions, owned by one organizer."""
+    from google.appengine.ext import ndb
+    import models
+    _local.user = FakeUser('organizer@example.com')
+    confKeys, sessKeys = [], []
+    for i in range(conferences):
+        form = models.ConferenceForm(
+            name='Load Conference %d' % i, city=random.choice(
+                ['London', 'Paris', 'Tokyo']), topics=['Web Technologies'],
+            startDate='2030-06-%02d' % (i % 28 + 1),
+            maxAttendees=SEATS_PER_CONFERENCE)
+        api._createConferenceObject(form)
+    for conf in models.Conference.query():
+        wsck = conf.key.urlsafe()
+        confKeys.append(wsck)
+        for j in range(SESSIONS_PER_CONFERENCE):
+            request = api.createSession.remote.request_type(
+                websafeConferenceKey=wsck, name='Session %d' % j,
+                speakers=['Speaker %d' % (j % 3)], startTime='10:00',
+                duration='01:00', date='2030-06-01')
+            sessKeys.append(api._createSessionObject(request).websafeKey)
+    ndb.get_context().clear_cache()
+    return confKeys, sessKeys
+
+
+def runUser(api, userIndex, ops, confKeys, sessKeys, stats):
+    """Run one simulated user's sequence of operations."""
+    from google.appengine.ext import ndb
+    from protorpc import message_types
+    import models
+    _local.user = FakeUser('user%d@example.com' % userIndex)
+    ops_choice = []
+    for op, weight in MIX:
+        ops_choice.extend([op] * weight)
+    for _ in range(ops):
+        op = random.choice(ops_choice)
+        wsck = random.choice(confKeys)
+        if op in ('getConference', 'getConferenceSessions',
+                  'registerForConference', 'unregisterFromConference'):
+            request = getattr(api, op).remote.request_type(
+                websafeConferenceKey=wsck)
+        elif op == 'addSessionToWishlist':
+            request = api.addSessionToWishlist.remote.request_type(
+                websafeSessionKey=random.choice(sessKeys))
+        elif op == 'queryConferences':
+            request = models.ConferenceQueryForms(filters=[
+                models.ConferenceQueryForm(field='CITY', operator='EQ',
+                                           value='London')])
+        else:
+            request = message_types.VoidMessage()
+        # every simulated request starts with an empty in-context cache
+        ndb.get_context().clear_cache()
+        start = time.time()
+        try:
+            getattr(api, op)(request)
+            outcome = 'ok'
+        except Exception as e:
+            outcome = e.__class__.__name__
+        stats.record(op, time.time() - start, outcome)
+
+
+def checkSeats(confKeys):
+    """Return (conference, seatsAvailable, registered) for every mismatch."""
+    from google.appengine.ext import ndb
+    import conference
+    import models
+    ndb.get_context().clear_cache()
+    registered = collections.Counter()
+    for prof in models.Profile.query():
+        registered.update(prof.conferenceKeysToAttend)
+    problems = []
+    for wsck in confKeys:
+        conf = ndb.Key(urlsafe=wsck).get()
+        seats = conference.ConferenceApi._getSeatsAvailable([conf])[conf.key]
+        if seats < 0 or seats + registered[wsck] != conf.maxAttendees:
+            problems.append((conf.name, seats, registered[wsck]))
+    return problems
+
+
+def main(users=50, ops=40, conferences=5):
+    tb = harness.activateTestbed()
+    import conference
+    import txstats
+    # counters stay in the instance until read, so no flush is lost to a
+    # contended compare-and-set
+    txstats.TX_STATS_FLUSH_SECONDS = 1e9
+
+    stats = Stats()
+    conference.endpoints.get_current_user = _currentUser
+    api = conference.ConferenceApi()
+    confKeys, sessKeys = seed(api, conferences)
+    # counted from here on, so seeding transactions are left out
+    baseline = txCounts()
+
+    threads = [threading.Thread(
+        target=runUser, name='user%d' % i,
+        args=(api, i, ops, confKeys, sessKeys, stats)) for i in range(users)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    total = sum(len(v) for v in stats.latency.values())
+    print '%d users x %d ops in %.2fs: %.1f ops/s' % (
+        users, ops, elapsed, total / max(elapsed, 1e-6))
+    print
+    print '%-26s %6s %8s %8s %8s  outcomes' % (
+        'operation', 'count', 'p50 ms', 'p95 ms', 'p99 ms')
+    for op, _ in MIX:
+        values = [v * 1000 for v in stats.latency[op]]
+        print '%-26s %6d %8.1f %8.1f %8.1f  %s' % (
+            op, len(values), harness.percentile(values, 50),
+            harness.percentile(values, 95), harness.percentile(values, 99),
+            ', '.join('%s=%d' % kv for kv in
+                      sorted(stats.outcomes[op].items())))
+
+    # a collision is a TransactionFailedError on commit; it is retried,
+    # or counted as a failure once the site's retries are used up
+    print
+    print '%-26s %6s %8s %8s %10s %8s' % (
+        'transaction site', 'calls', 'attempts', 'retries', 'collisions',
+        'failures')
+    for site, counts in sorted(txCounts().items()):
+        counts.subtract(baseline[site])
+        print '%-26s %6d %8d %8d %10d %8d' % (
+            site, counts['calls'], counts['attempts'], counts['retries'],
+            counts['collisions'], counts['failures'])
+
+    problems = checkSeats(confKeys)
+    if problems:
+        print 'SEAT COUNT MISMATCH:'
+        for name, seats, registered in problems:
+            print '  %s: seatsAvailable=%d registered=%d' % (
+                name, seats, registered)
+        sys.exit(1)
+    print 'seat counts consistent across %d conferences' % len(confKeys)
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+rekey_check.py -- tests that moving a conference to a root key keeps
+    everything under it, on the testbed stubs
+
+usage: GAE_SDK=<sdk dir> python tools/rekey_check.py [-v] [test name ...]
+
+The stub hands out ids from one counter for the whole datastore, where
+App Engine counts them per parent; the tests allocate per parent as App
+Engine does, so an id the new group never reserved shows up as reused.
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import collections
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tools import harness
+from tools.loadtest import FakeUser
+from tools.rpc_budget import Fixture
+from tools.rpc_budget import ORGANIZER
+
+
+def allocatePerParent(stub):
+    """Make stub allocate sequential ids separately under every parent."""
+    counters = collections.defaultdict(lambda: 1)
+
+    def allocate(reference, size=1, max_id=None):
+        parent = tuple((el.type(), el.id(), el.name()) for el in
+                       reference.path().element_list()[:-1])
+        start = counters[parent]
+        counters[parent] = start + size if size else max(start, max_id + 1)
+        return start, counters[parent] - 1
+    stub._AllocateSequentialIds = allocate
+
+
+class MoveConferenceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        harness.fixSysPath()
+
+    def setUp(self):
+        from google.appengine.ext import testbed
+        self.testbed = harness.activateTestbed()
+        allocatePerParent(self.testbed.get_stub(
+            testbed.DATASTORE_SERVICE_NAME))
+        self.fx = Fixture(self.testbed, 2)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def move(self):
+        from google.appengine.ext import ndb
+        import rekey
+        return rekey.moveConference(ndb.Key(urlsafe=self.fx.conf))
+
+    def testNewSessionKeepsMovedSessions(self):
+        from models import Session
+        new_key = self.move()
+        moved = Session.query(ancestor=new_key).fetch()
+        self.fx.user = FakeUser(ORGANIZER)
+        self.fx.api('createSession', websafeConferenceKey=new_key.urlsafe(),
+                    name='After The Move', speakers=['Speaker 0-0'],
+                    startTime='18:00', duration='01:00', date='2030-06-01')
+        names = sorted(sess.name for sess in
+                       Session.query(ancestor=new_key).fetch())
+        self.assertEqual(names, sorted([sess.name for sess in moved] +
+                                       ['After The Move']))
+
+    def testRecommendationsMoveWithTheSessions(self):
+        from google.appengine.ext import ndb
+        from models import Session
+        before = self.fx.api('getRecommendedSessions',
+                             websafeSessionKey=self.fx.session)
+        new_key = self.move()
+        s_key = ndb.Key(Session, ndb.Key(urlsafe=self.fx.session).id(),
+                        parent=new_key)
+        after = self.fx.api('getRecommendedSessions',
+                            websafeSessionKey=s_key.urlsafe())
+        self.assertTrue(before.items)
+        self.assertEqual([form.name for form in after.items],
+                         [form.name for form in before.items])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+
+"""
+rpc_budget.py -- tests that every ConferenceApi method and main.py handler
+    stays within a budget of service RPCs and datastore entities read, on
+    the testbed stubs, at two dataset sizes; calls that should cost the
+    same however big the dataset is must not grow from the small to the
+    large one. Failures list the app frames behind each RPC.
+
+usage: GAE_SDK=<sdk dir> python tools/rpc_budget.py [-v] [test name ...]
+       GAE_SDK=<sdk dir> python tools/rpc_budget.py --report
+
+The budgets are the counts measured by --report; raise one only together
+with the change that needs it.
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import os
+import re
+import sys
+import traceback
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tools import harness
+from tools.loadtest import FakeUser
+
+# conferences per dataset; sessions per conference stay fixed, so calls
+# scoped to one conference should not notice the difference
+SIZES = [('small', 2), ('large', 8)]
+SESSIONS_PER_CONFERENCE = 4
+# rounds of queued tasks run after seeding; tasks enqueue further tasks
+MAX_TASK_ROUNDS = 20
+PROFILES_PER_CONFERENCE = 3
+ORGANIZER = 'organizer@example.com'
+ATTENDEE = 'attendee@example.com'
+
+# (name, user, call, max RPCs, max entities read, constant across sizes)
+# call(fx) runs one ConferenceApi method (fx.api) or main.py handler
+# (fx.handler); RPCs include memcache, task queue and OAuth lookups, so
+# rate-limited methods pay for two token reservations in their budget,
+# and every ndb get that misses memcache pays for ndb's memcache lock.
+CASES = [
+    # - - - reads scoped to one conference, session or user - - -
+    ('getConference', ATTENDEE,
+     lambda fx: fx.api('getConference', websafeConferenceKey=fx.conf),
+     10, 2, True),
+    ('getConferenceSessions', ATTENDEE,
+     lambda fx: fx.api('getConferenceSessions', websafeConferenceKey=fx.conf),
+     14, 7, True),
+    ('getConferenceSessionsByType', ATTENDEE,
+     lambda fx: fx.api('getConferenceSessionsByType',
+                       websafeConferenceKey=fx.conf,
+                       typeOfSession=fx.workshop),
+     14, 7, True),
+    ('getConferenceSessionsEndingBefore', ATTENDEE,
+     lambda fx: fx.api('getConferenceSessionsEndingBefore',
+                       websafeConferenceKey=fx.conf, endTime='18:00'),
+     11, 7, True),
+    ('getSessionsBySpeaker', ATTENDEE,
+     lambda fx: fx.api('getSessionsBySpeaker', name=fx.speaker),
+     9, 3, True),
+    ('getConferenceStats', ATTENDEE,
+     lambda fx: fx.api('getConferenceStats', websafeConferenceKey=fx.conf),
+     5, 1, True),
+    ('getRecommendedSessions', ATTENDEE,
+     lambda fx: fx.api('getRecommendedSessions',
+                       websafeSessionKey=fx.session),
+     15, 5, True),
+    ('getFeaturedSpeaker', ATTENDEE,
+     lambda fx: fx.api('getFeaturedSpeaker', websafeConferenceKey=fx.conf),
+     6, 1, True),
+    ('getAnnouncement', ATTENDEE,
+     lambda fx: fx.api('getAnnouncement'),
+     1, 0, True),
+    ('getProfile', ATTENDEE,
+     lambda fx: fx.api('getProfile'),
+     5, 1, True),
+    ('getConferencesToAttend', ATTENDEE,
+     lambda fx: fx.api('getConferencesToAttend'),
+     15, 3, True),
+    ('getSessionsInWishlist', ATTENDEE,
+     lambda fx: fx.api('getSessionsInWishlist'),
+     15, 6, True),
+    ('batch', ATTENDEE,
+     lambda fx: fx.api('batch', requests=[
+         fx.subRequest('getConference', websafeConferenceKey=fx.conf),
+         fx.subRequest('getProfile'),
+         fx.subRequest('getConferenceSessions',
+                       websafeConferenceKey=fx.conf)]),
+     19, 10, True),
+    ('batch with a bad key', ATTENDEE, lambda fx: batchWithBadKey(fx),
+     5, 3, True),
+    # - - - writes - - -
+    ('createConference', ORGANIZER,
+     lambda fx: fx.api('createConference', name='Budget Conference',
+                       city='Paris', topics=['Budgets'],
+                       startDate='2030-07-01', maxAttendees=10),
+     18, 1, True),
+    ('updateConference', ORGANIZER,
+     lambda fx: fx.api('updateConference', websafeConferenceKey=fx.conf,
+                       city='Berlin'),
+     13, 2, True),
+    ('deleteConference', ORGANIZER,
+     lambda fx: fx.api('deleteConference', websafeConferenceKey=fx.conf),
+     18, 1, True),
+    ('createSession', ORGANIZER,
+     lambda fx: fx.api('createSession', websafeConferenceKey=fx.conf,
+                       name='Budget Session', speakers=[fx.speaker],
+                       startTime='16:00', duration='01:00',
+                       date='2030-06-01'),
+     17, 4, True),
+    ('deleteSession', ORGANIZER,
+     lambda fx: fx.api('deleteSession', websafeSessionKey=fx.session),
+     # the speaker's sessions are queried alongside the delete, which the
+     # query may or may not see yet
+     10, 4, False),
+    ('registerForConference', ATTENDEE,
+     lambda fx: fx.api('registerForConference',
+                       websafeConferenceKey=fx.other),
+     18, 4, True),
+    ('unregisterFromConference', ATTENDEE,
+     lambda fx: fx.api('unregisterFromConference',
+                       websafeConferenceKey=fx.conf),
+     15, 3, True),
+    ('leaveWaitlist', ATTENDEE,
+     lambda fx: fx.api('leaveWaitlist', websafeConferenceKey=fx.conf),
+     4, 0, True),
+    ('addSessionToWishlist', ATTENDEE,
+     lambda fx: fx.api('addSessionToWishlist',
+                       websafeSessionKey=fx.other_session),
+     7, 2, True),
+    ('saveProfile', ATTENDEE,
+     lambda fx: fx.api('saveProfile', displayName='Renamed'),
+     9, 1, True),
+    # - - - listings; entities grow with the matches, RPCs should not - - -
+    ('queryConferences', ATTENDEE,
+     lambda fx: fx.api('queryConferences', filters=[fx.cityFilter()]),
+     9, 8, False),
+    ('getConferencesCreated', ORGANIZER,
+     lambda fx: fx.api('getConferencesCreated'),
+     6, 16, False),
+    ('getMinAttndsConfs', ATTENDEE,
+     lambda fx: fx.api('getMinAttndsConfs'),
+     1, 0, False),
+    ('getMaxAttndsConfs', ATTENDEE,
+     lambda fx: fx.api('getMaxAttndsConfs'),
+     1, 0, False),
+    ('getConferenceFacets', ATTENDEE,
+     lambda fx: fx.api('getConferenceFacets'),
+     4, 29, False),
+    ('getConferenceCalendar', ATTENDEE,
+     lambda fx: fx.api('getConferenceCalendar', startDate='2030-06-01',
+                       endDate='2030-06-30'),
+     3, 8, False),
+    ('getTopSpeakers', ATTENDEE,
+     lambda fx: fx.api('getTopSpeakers'),
+     10, 48, False),
+    ('filterPlayground', ATTENDEE,
+     lambda fx: fx.api('filterPlayground'),
+     1, 0, False),
+    # - - - main.py handlers - - -
+    ('/crons/set_announcement', None,
+     lambda fx: fx.handler('/crons/set_announcement'),
+     2, 0, True),
+    ('/tasks/review_speakers_for_sessions', None,
+     lambda fx: fx.handler('/tasks/review_speakers_for_sessions',
+                           c_key_str=fx.conf),
+     7, 6, True),
+    ('/tasks/update_conference_stats', None,
+     lambda fx: fx.handler('/tasks/update_conference_stats',
+                           c_key_str=fx.conf),
+     7, 5, True),
+    ('/tasks/purge_conference', None,
+     lambda fx: fx.handler('/tasks/purge_conference', c_key_str=fx.conf,
+                           stage='sessions'),
+     5, 1, True),
+    ('/tasks/prune_wishlists', None,
+     lambda fx: fx.handler('/tasks/prune_wishlists',
+                           s_key_str=fx.session),
+     7, 2, True),
+    ('/tasks/promote_waitlist', None,
+     lambda fx: fx.handler('/tasks/promote_waitlist', c_key_str=fx.conf),
+     1, 0, True),
+    ('/tasks/update_organizer_name', None,
+     lambda fx: fx.handler('/tasks/update_organizer_name',
+                           user_id=ORGANIZER),
+     11, 17, False),
+    ('/tasks/update_facets', None,
+     lambda fx: fx.handler('/tasks/update_facets',
+                           deltas='[["city", "London", 1]]'),
+     # the shard the task name picks may or may not exist yet
+     7, 1, False),
+    ('/tasks/update_speaker_counts', None,
+     lambda fx: fx.handler('/tasks/update_speaker_counts',
+                           deltas='[["speaker_0-0", 1, 1, 0]]'),
+     # the shard the task name picks may or may not exist yet
+     6, 1, False),
+    ('/tasks/build_recommendations', None,
+     lambda fx: fx.handler('/tasks/build_recommendations',
+                           c_key_str=fx.conf),
+     13, 8, True),
+    ('/crons/sweep_counter_updates', None,
+     lambda fx: fx.handler('/crons/sweep_counter_updates'),
+     1, 0, True),
+    ('/crons/drain_mail_outbox', None,
+     lambda fx: fx.handler('/crons/drain_mail_outbox'),
+     4, 0, True),
+    ('/admin/cache_stats', None,
+     lambda fx: fx.handler('/admin/cache_stats'),
+     2, 0, True),
+    ('/admin/txstats', None,
+     lambda fx: fx.handler('/admin/txstats'),
+     3, 0, True),
+]
+
+
+class RpcRecorder(object):
+    """Post-call hook recording every RPC with the app frames behind it."""
+
+    def __init__(self):
+        self.calls = []
+        self.error = None
+
+    def record(self, service, call, request, response):
+        entities = 0
+        if service == 'datastore_v3':
+            if call == 'Get':
+                entities = sum(1 for group in response.entity_list()
+                               if group.has_entity())
+            elif call in ('RunQuery', 'Next'):
+                entities = response.result_size()
+        frames = [frame for frame in traceback.extract_stack()[:-1]
+                  if frame[0].startswith(harness.ROOT) and
+                  os.sep + 'tools' + os.sep not in frame[0]]
+        self.calls.append(('%s.%s' % (service, call), entities, frames))
+
+    def totals(self):
+        return len(self.calls), sum(entities for _, entities, _ in
+                                    self.calls)
+
+    def trace(self):
+        lines = []
+        for name, entities, frames in self.calls:
+            lines.append('    %-28s entities=%d' % (name, entities))
+            for filename, line, func, text in frames[-4:]:
+                lines.append('        %s:%d %s: %s' % (
+                    os.path.relpath(filename, harness.ROOT), line, func,
+                    text))
+        return '\n'.join(lines)
+
+
+class Fixture(object):
+    """A seeded dataset and helpers to call the API and the handlers."""
+
+    def __init__(self, tb, conferences):
+        import conference
+        from models import Conference
+        from models import Session
+        from models import TypeOfSession
+
+        self.testbed = tb
+        self.user = None
+        self.workshop = TypeOfSession.Workshop
+        conference.endpoints.get_current_user = lambda: self.user
+        self.conference = conference
+        self.apiInstance = conference.ConferenceApi()
+
+        self.user = FakeUser(ORGANIZER)
+        self.apiInstance.saveProfile(self._request(
+            'saveProfile', displayName='Organizer'))
+        for i in range(conferences):
+            self.apiInstance.createConference(self._request(
+                'createConference', name='Conference %d' % i,
+                city=['London', 'Paris'][i % 2], topics=['Web'],
+                startDate='2030-06-%02d' % (i % 28 + 1), maxAttendees=20))
+        confs = Conference.query().order(Conference.name).fetch()
+        for i, conf in enumerate(confs):
+            for j in range(SESSIONS_PER_CONFERENCE):
+                # two speakers per conference, each in two sessions
+                self.apiInstance.createSession(self._request(
+                    'createSession', websafeConferenceKey=conf.key.urlsafe(),
+                    name='Session %d-%d' % (i, j),
+                    speakers=['Speaker %d-%d' % (i, j % 2)],
+                    typeOfSession=self.workshop, startTime='%02d:00' % (9 + j),
+                    duration='01:00', date='2030-06-01'))
+        self.conf = confs[0].key.urlsafe()
+        self.other = confs[1].key.urlsafe()
+        sessions = Session.query(ancestor=confs[0].key).fetch(keys_only=True)
+        self.session = sessions[0].urlsafe()
+        self.other_session = Session.query(ancestor=confs[1].key).fetch(
+            1, keys_only=True)[0].urlsafe()
+        self.speaker = 'Speaker 0-0'
+
+        # the attendee goes to the first conference and wishlists three of
+        # its sessions; everybody else only adds to the dataset size
+        self.user = FakeUser(ATTENDEE)
+        self.apiInstance.registerForConference(self._request(
+            'registerForConference', websafeConferenceKey=self.conf))
+        for s_key in sessions[:3]:
+            self.apiInstance.addSessionToWishlist(self._request(
+                'addSessionToWishlist', websafeSessionKey=s_key.urlsafe()))
+        for i in range(conferences * PROFILES_PER_CONFERENCE):
+            self.user = FakeUser('filler%d@example.com' % i)
+            self.apiInstance.saveProfile(self._request(
+                'saveProfile', displayName='Filler %d' % i))
+        self.user = None
+
+        # counters, statistics, catalog and recommendations as the queued
+        # tasks and the crons leave them
+        self.runTasks()
+        self.handler('/crons/build_recommendations')
+        self.runTasks()
+
+    def _request(self, method, **fields):
+        return getattr(self.apiInstance, method).remote.request_type(
+            **fields)
+
+    def api(self, method, **fields):
+        return getattr(self.apiInstance, method)(self._request(method,
+                                                               **fields))
+
+    def subRequest(self, method, **params):
+        import json
+        from models import BatchSubRequest
+        return BatchSubRequest(method=method, params=json.dumps(params))
+
+    def cityFilter(self):
+        from models import ConferenceQueryForm
+        return ConferenceQueryForm(field='CITY', operator='EQ',
+                                   value='London')
+
+    def handler(self, path, taskName=None, **params):
+        """Call a main.py handler, as a task when POSTed params."""
+        import main
+        if params:
+            # task handlers tell retries apart by the task name
+            response = main.app.get_response(path, POST=params, headers={
+                'X-AppEngine-TaskName': taskName or 'rpc-budget'})
+        else:
+            response = main.app.get_response(path)
+        if response.status_int >= 500:
+            raise RuntimeError('%s returned %s' % (path, response.status))
+        return response
+
+    def runTasks(self):
+        """Run the queued push tasks, and those they enqueue, to the end."""
+        import main
+        from google.appengine.ext import testbed
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        for _ in range(MAX_TASK_ROUNDS):
+            tasks = stub.get_filtered_tasks(queue_names=['default'])
+            if not tasks:
+                return
+            stub.FlushQueue('default')
+            for task in tasks:
+                headers = dict(task.headers)
+                headers['X-AppEngine-TaskName'] = task.name
+                response = main.app.get_response(
+                    task.url, method=task.method, body=task.payload or '',
+                    headers=headers)
+                if response.status_int >= 500:
+                    raise RuntimeError('task %s returned %s' % (
+                        task.url, response.status))
+        raise RuntimeError('tasks still queued after %d rounds' %
+                           MAX_TASK_ROUNDS)
+
+
+def batchWithBadKey(fx):
+    """A malformed key fails only its own sub-request."""
+    response = fx.api('batch', requests=[
+        fx.subRequest('getConference', websafeConferenceKey='garbage'),
+        fx.subRequest('getConference', websafeConferenceKey=fx.conf)])
+    codes = [sub.code for sub in response.responses]
+    if codes != [400, 200]:
+        raise AssertionError('sub-request codes %s' % codes)
+
+
+def resetInstanceState():
+    """Start each measured call with cold per-request and instance caches."""
+    from google.appengine.ext import ndb
+    import caches
+    import profilecache
+    import ratelimit
+    ndb.get_context().clear_cache()
+    # outside App Engine os.environ is not reset between requests
+    os.environ.pop(profilecache._REQUEST_MARKER, None)
+    caches.ANNOUNCEMENT_CACHE.clear()
+    caches.FEATURED_CACHE.clear()
+    caches.ORGANIZER_NAMES.clear()
+    caches.PROFILES.clear()
+    ratelimit._LOCAL = ratelimit._LocalTokens()
+
+
+def measure(conferences, user, call):
+    """Seed a fresh dataset, run call once and return its RpcRecorder."""
+    tb = harness.activateTestbed()
+    try:
+        from google.appengine.api import apiproxy_stub_map
+        import caches
+        import txstats
+        # telemetry flushes would add RPCs at random points
+        caches.STATS_FLUSH_SECONDS = txstats.TX_STATS_FLUSH_SECONDS = 1e9
+
+        fx = Fixture(tb, conferences)
+        resetInstanceState()
+        fx.user = FakeUser(user) if user else None
+        recorder = RpcRecorder()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'rpc_budget', recorder.record)
+        try:
+            call(fx)
+        except Exception as e:
+            recorder.error = '%s: %s' % (type(e).__name__, e)
+        return recorder
+    finally:
+        tb.deactivate()
+
+
+def check(maxRpcs, maxEntities, constant, runs):
+    """Return [(size, problem)] for the recorders of one case."""
+    problems = []
+    for size, recorder in runs:
+        rpcs, entities = recorder.totals()
+        if recorder.error:
+            problems.append((size, 'raised %s' % recorder.error))
+        if rpcs > maxRpcs:
+            problems.append((size, '%d RPCs > budget %d' % (rpcs, maxRpcs)))
+        if entities > maxEntities:
+            problems.append((size, '%d entities > budget %d' % (
+                entities, maxEntities)))
+    (_, small), (_, large) = runs
+    if constant and large.totals() > small.totals():
+        problems.append(('large', 'grew with the dataset: %s -> %s' % (
+            small.totals(), large.totals())))
+    return problems
+
+
+class RpcBudgetTest(unittest.TestCase):
+    """One test per entry of CASES, each run on both dataset sizes."""
+
+    @classmethod
+    def setUpClass(cls):
+        harness.fixSysPath()
+
+
+def _budgetTest(name, user, call, maxRpcs, maxEntities, constant):
+    def test(self):
+        runs = [(size, measure(conferences, user, call)) for size,
+                conferences in SIZES]
+        problems = check(maxRpcs, maxEntities, constant, runs)
+        if problems:
+            failed = set(size for size, _ in problems)
+            self.fail('\n'.join(['%s: %s' % problem for problem in problems] +
+                                ['%s dataset RPCs:\n%s' % (size,
+                                 recorder.trace()) for size, recorder in runs
+                                 if size in failed]))
+    test.__name__ = 'test_' + re.sub(r'\W+', '_', name).strip('_')
+    test.__doc__ = name
+    return test
+
+
+for _case in CASES:
+    _test = _budgetTest(*_case)
+    setattr(RpcBudgetTest, _test.__name__, _test)
+
+
+def report():
+    """Print the counts measured for every case next to its budget."""
+    harness.fixSysPath()
+    print '%-38s %13s %13s  %s' % ('call', 'rpcs s/l', 'entities s/l',
+                                   'budget')
+    for name, user, call, maxRpcs, maxEntities, constant in CASES:
+        runs = [(size, measure(conferences, user, call)) for size,
+                conferences in SIZES]
+        (_, small), (_, large) = runs
+        print '%-38s %6d/%-6d %6d/%-6d  %d/%d%s' % (
+            name, small.totals()[0], large.totals()[0], small.totals()[1],
+            large.totals()[1], maxRpcs, maxEntities,
+            '' if not check(maxRpcs, maxEntities, constant, runs) else
+            '  FAIL')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--report']:
+        report()
+    else:
+        unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+txstats.py -- Udacity conference server-side Python App Engine
+    transactions with per call site retry policies and contention
+    telemetry, aggregated in memcache over a rolling window
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+import collections
+import functools
+import random
+import threading
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from settings import TX_RETRY_POLICIES
+
+# per-instance counters are merged into the memcache aggregate this often
+TX_STATS_FLUSH_SECONDS = 10
+# the aggregate covers this many one-minute buckets
+TX_STATS_WINDOW_MINUTES = 60
+MEMCACHE_TX_STATS_TPL = "TXSTATS:%d"
+HOT_GROUPS_REPORTED = 10
+
+
+def _merge(bucket, sites, groups):
+    """Add pending counters to a minute bucket read from memcache."""
+    bucket = bucket or {'sites': {}, 'groups': {}}
+    for site, counts in sites.items():
+        merged = collections.Counter(bucket['sites'].get(site, {}))
+        merged.update(counts)
+        bucket['sites'][site] = dict(merged)
+    for site, counts in groups.items():
+        merged = collections.Counter(bucket['groups'].get(site, {}))
+        merged.update(counts)
+        # only the hottest groups are worth their memcache space
+        bucket['groups'][site] = dict(merged.most_common(
+            HOT_GROUPS_REPORTED * 5))
+    return bucket
+
+
+class _Recorder(object):
+    """Counters of this instance not yet merged into memcache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sites = collections.defaultdict(collections.Counter)
+        self._groups = collections.defaultdict(collections.Counter)
+        self._flushed = time.time()
+
+    def record(self, site, counts, groups=()):
+        with self._lock:
+            self._sites[site].update(counts)
+            self._groups[site].update(groups)
+            due = time.time() - self._flushed >= TX_STATS_FLUSH_SECONDS
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Merge the pending counters into the current minute's bucket."""
+        with self._lock:
+            sites, self._sites = self._sites, collections.defaultdict(
+                collections.Counter)
+            groups, self._groups = self._groups, collections.defaultdict(
+                collections.Counter)
+            self._flushed = time.time()
+        if not sites:
+            return
+        key = MEMCACHE_TX_STATS_TPL % (int(time.time()) // 60)
+        timeout = (TX_STATS_WINDOW_MINUTES + 1) * 60
+        client = memcache.Client()
+        # a few compare-and-set rounds; losing a flush only loses telemetry
+        for _ in range(3):
+            bucket = client.gets(key)
+            if bucket is None:
+                stored = client.add(key, _merge(None, sites, groups),
+                                    time=timeout)
+            else:
+                stored = client.cas(key, _merge(bucket, sites, groups),
+                                    time=timeout)
+            if stored:
+                return
+
+
+_RECORDER = _Recorder()
+
+
+def _touchedGroups():
+    """Return the entity groups the current transaction has used.
+
+    The transaction's context cache holds every entity it got or put.
+    """
+    cache = getattr(ndb.get_context(), '_cache', None) or {}
+    return set(key.root().urlsafe() for key in cache.keys())
+
+
+def transactional(site, xg=False):
+    """Decorator like ndb.transactional(xg=xg) that also keeps telemetry.
+
+    Retries and backoff come from TX_RETRY_POLICIES[site] (or 'default').
+    Every call records its attempts, retries, failures, collision reasons
+    and time spent, and the entity groups of attempts that collided. A
+    call made inside another transaction simply joins it.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwds):
+            if ndb.in_transaction():
+                return func(*args, **kwds)
+            policy = dict(TX_RETRY_POLICIES['default'])
+            policy.update(TX_RETRY_POLICIES.get(site, {}))
+            counts = collections.Counter(calls=1)
+            hotGroups = collections.Counter()
+            touched = []
+
+            def attempt():
+                try:
+                    return func(*args, **kwds)
+                finally:
+                    # commit happens after this returns; remember what
+                    # this attempt used in case the commit collides
+                    touched[:] = _touchedGroups()
+
+            started = time.time()
+            try:
+                for retry in range(policy['retries'] + 1):
+                    counts['attempts'] += 1
+                    try:
+                        return ndb.transaction(attempt, retries=0, xg=xg)
+                    except datastore_errors.TransactionFailedError:
+                        counts['collisions.TransactionFailedError'] += 1
+                        hotGroups.update(touched)
+                        if retry == policy['retries']:
+                            counts['failures'] += 1
+                            raise
+                        counts['retries'] += 1
+                        # exponential backoff with jitter, spreading out
+                        # the writers that collided
+                        delay = min(policy['backoff'] * 2 ** retry,
+                                    policy['maxBackoff'])
+                        time.sleep(delay * random.uniform(0.5, 1.0))
+                    except (datastore_errors.Timeout,
+                            datastore_errors.InternalError) as e:
+                        # the commit may have gone through; not retried
+                        counts['collisions.%s' % type(e).__name__] += 1
+                        counts['failures'] += 1
+                        hotGroups.update(touched)
+                        raise
+            finally:
+                counts['totalMs'] += int((time.time() - started) * 1000)
+                _RECORDER.record(site, counts, hotGroups)
+        return wrapper
+    return decorator
+
+
+def report():
+    """Return the per call site totals over the rolling window."""
+    _RECORDER.flush()
+    now = int(time.time()) // 60
+    buckets = memcache.get_multi([MEMCACHE_TX_STATS_TPL % minute for minute
+                                  in range(now - TX_STATS_WINDOW_MINUTES + 1,
+                                           now + 1)])
+    sites = collections.defaultdict(collections.Counter)
+    groups = collections.defaultdict(collections.Counter)
+    for bucket in buckets.values():
+        for site, counts in bucket['sites'].items():
+            sites[site].update(counts)
+        for site, counts in bucket['groups'].items():
+            groups[site].update(counts)
+    result = {}
+    for site, counts in sites.items():
+        collisions = dict((name.split('.', 1)[1], n) for name, n in
+                          counts.items() if name.startswith('collisions.'))
+        result[site] = {
+            'calls': counts['calls'],
+            'attempts': counts['attempts'],
+            'retries': counts['retries'],
+            'failures': counts['failures'],
+            'collisions': collisions,
+            'avgMs': (float(counts['totalMs']) / counts['calls']
+                      if counts['calls'] else None),
+            'policy': dict(TX_RETRY_POLICIES['default'],
+                           **TX_RETRY_POLICIES.get(site, {})),
+            'hottestGroups': groups[site].most_common(HOT_GROUPS_REPORTED),
+        }
+    return {'windowMinutes': TX_STATS_WINDOW_MINUTES, 'sites': result}
@@ -43,3 +43,44 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+def sessionTimeFields(date, startTime, duration):
+    """Return the integer schedule fields stored on a Session.
+
+    startMinutes and endMinutes are minutes since midnight; startOrdinal
+    combines the date and the start time so a single integer orders
+    sessions across days.
+    """
+    fields = {'startMinutes': None, 'endMinutes': None, 'startOrdinal': None}
+    if startTime is None:
+        return fields
+    start = startTime.hour * 60 + startTime.minute
+    fields['startMinutes'] = start
+    if duration is not None:
+        fields['endMinutes'] = start + duration.hour * 60 + duration.minute
+    if date is not None:
+        fields['startOrdinal'] = date.toordinal() * 24 * 60 + start
+    return fields
+
+
+# conferences running longer are only listed in their first months
+MAX_ACTIVE_MONTHS = 24
+
+
+def activeMonths(startDate, endDate):
+    """Return the months a conference runs in, as YYYYMM integers.
+
+    Stored as Conference.activeMonths so one equality filter finds every
+    conference overlapping a month.
+    """
+    if startDate is None:
+        return []
+    end = max(endDate or startDate, startDate)
+    year, month = startDate.year, startDate.month
+    months = []
+    while ((year, month) <= (end.year, end.month) and
+           len(months) < MAX_ACTIVE_MONTHS):
+        months.append(year * 100 + month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+waitlist.py -- Udacity conference server-side Python App Engine
+    waitlists for sold-out conferences; users append themselves outside
+    the conference's entity group and freed seats are handed out in
+    batches by a task
+
+$Id$
+"""
+
+__authors__ = 'wesc+api@google.com (Wesley Chun) and Landon Bennett'
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import profilecache
+import txstats
+from models import ConferenceSeats
+from models import Profile
+from models import WaitlistEntry
+
+# one cross-group transaction may touch at most 25 entity groups: the
+# conference, then an entry and a profile per promoted user
+PROMOTE_BATCH_SIZE = 12
+
+
+def entryKey(c_key, user_id):
+    """Return the key of a user's entry on a conference waitlist."""
+    # a root entity per user and conference, so joining never writes to
+    # the conference's group and joining twice keeps the first place
+    return ndb.Key(WaitlistEntry, '%s|%s' % (c_key.urlsafe(), user_id))
+
+
+def _seatsKey(c_key):
+    # same key as ConferenceApi._seatsKey
+    return ndb.Key(ConferenceSeats, 1, parent=c_key)
+
+
+@ndb.transactional
+def join(c_key, user_id):
+    """Append a user to a conference waitlist; return their entry."""
+    key = entryKey(c_key, user_id)
+    entry = key.get()
+    if entry is None:
+        entry = WaitlistEntry(key=key, conference=c_key, userId=user_id)
+        entry.put()
+    return entry
+
+
+def leave(c_key, user_id):
+    """Take a user off a conference waitlist; False if they weren't on."""
+    key = entryKey(c_key, user_id)
+    if key.get() is None:
+        return False
+    key.delete()
+    return True
+
+
+def position(entry):
+    """Return the 1-based place of an entry on its waitlist."""
+    return WaitlistEntry.query(
+        WaitlistEntry.conference == entry.conference,
+        WaitlistEntry.created < entry.created).count() + 1
+
+
+def hasWaiting(c_key):
+    """Return True if anybody is on a conference waitlist."""
+    return WaitlistEntry.query(WaitlistEntry.conference == c_key).get(
+        keys_only=True) is not None
+
+
+def enqueuePromotion(c_key, transactional=False):
+    """Hand out a conference's free seats to its waitlist in the
+    background."""
+    taskqueue.add(params={'c_key_str': c_key.urlsafe()},
+                  url='/tasks/promote_waitlist',
+                  transactional=transactional)
+
+
+@txstats.transactional('waitlistPromotion', xg=True)
+def _promote(c_key, e_keys):
+    """Register waitlisted users into free seats, oldest first.
+
+    The seat inventory is written once for the whole batch. Returns the
+    seats still available afterwards.
+    """
+    conf, seats = ndb.get_multi([c_key, _seatsKey(c_key)])
+    if conf is None or conf.deleted:
+        return 0
+    if seats is None:
+        # conference created before seat inventories existed
+        seats = ConferenceSeats(key=_seatsKey(c_key),
+                                seatsAvailable=conf.seatsAvailable)
+    # entries found by the query may have left since
+    entries = sorted((entry for entry in ndb.get_multi(e_keys) if entry),
+                     key=lambda entry: entry.created)
+    profiles = ndb.get_multi([ndb.Key(Profile, entry.userId) for entry in
+                              entries])
+    wsck = c_key.urlsafe()
+    done = []
+    changed = []
+    for entry, prof in zip(entries, profiles):
+        if seats.seatsAvailable <= 0:
+            break
+        done.append(entry.key)
+        # users who registered on their own just leave the waitlist
+        if prof is None or wsck in prof.conferenceKeysToAttend:
+            continue
+        prof.conferenceKeysToAttend.append(wsck)
+        seats.seatsAvailable -= 1
+        changed.append(prof)
+        profilecache.invalidate(prof.key)
+    if done:
+        ndb.put_multi(changed + [seats])
+        ndb.delete_multi(done)
+    return seats.seatsAvailable
+
+
+def promoteBatch(c_key):
+    """Promote the next batch of a conference's waitlist.
+
+    Returns True if seats and waitlisted users may both be left.
+    """
+    e_keys = WaitlistEntry.query(WaitlistEntry.conference == c_key).order(
+        WaitlistEntry.created).fetch(PROMOTE_BATCH_SIZE, keys_only=True)
+    if not e_keys:
+        return False
+    return _promote(c_key, e_keys) > 0 and len(e_keys) == PROMOTE_BATCH_SIZE